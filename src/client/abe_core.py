@@ -2,10 +2,152 @@ from charm.toolbox.pairinggroup import PairingGroup,ZR,G1,G2,GT,pair
 from charm.adapters.abenc_adapt_hybrid import HybridABEnc
 from charm.schemes.abenc.abenc_bsw07 import CPabe_BSW07
 from charm.core.engine.util import objectToBytes, bytesToObject
+from charm.toolbox.secretutil import SecretUtil
+from charm.toolbox.symcrypto import AuthenticatedCryptoAbstraction
+from charm.core.math.pairing import hashPair as sha2
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import *
+from collections import deque
+from itertools import chain
+from base64 import b64decode
+import threading
+import struct
 import os
 
+PRECOMPUTE_TABLES = True
+OFFLINE_POOL_SIZE = 4
+
+# Envelope: version byte, big-endian length of the ABE key blob, the key blob
+# (objectToBytes output) and then the raw AES-GCM body (nonce + ct + tag).
+ENVELOPE_VERSION = 1
+ENVELOPE_HEADER = struct.Struct('>BI')
+LEGACY_SIGN = b'DEADBEEF'
+
+# Streaming envelope: same prefix with version 2, then the segment size and
+# a 7-byte nonce prefix, then segments of ciphertext + 16-byte GCM tag.
+STREAM_VERSION = 2
+STREAM_HEADER = struct.Struct('>I7s')
+SEGMENT_SIZE = 1024 * 1024
+TAG_SIZE = 16
+
+# First read when only the header is wanted; grown if the key blob is bigger.
+HEADER_PROBE_SIZE = 16 * 1024
+
+group = PairingGroup('SS512')
+public_keys = {}
+
+def precomputeTables(pk):
+    for name in ('g', 'g2', 'h', 'e_gg_alpha'):
+        if not pk[name].preproc:
+            pk[name].initPP()
+
+    return pk
+
+def loadPublicKey(pk):
+    # Deserialize each public key once per process and keep its fixed-base
+    # tables around for every later encrypt/decrypt.
+    if isinstance(pk, dict):
+        return pk
+    if pk not in public_keys:
+        obj = bytesToObject(pk, group)
+        if PRECOMPUTE_TABLES:
+            precomputeTables(obj)
+        public_keys[pk] = obj
+
+    return public_keys[pk]
+
+def parseHeader(data):
+    # Returns the envelope header once enough of it has been read, otherwise
+    # None. 'length' is where the body starts.
+    if len(data) and data[0] in (ENVELOPE_VERSION, STREAM_VERSION):
+        if len(data) < ENVELOPE_HEADER.size:
+            return None
+        version, length = ENVELOPE_HEADER.unpack_from(data)
+        end = ENVELOPE_HEADER.size + length
+        if version == STREAM_VERSION:
+            end += STREAM_HEADER.size
+        if len(data) < end:
+            return None
+
+        header = {'version': version, 'key': bytes(data[ENVELOPE_HEADER.size:ENVELOPE_HEADER.size + length]), 'length': end}
+        if version == STREAM_VERSION:
+            header['segment_size'], header['prefix'] = STREAM_HEADER.unpack_from(data, end - STREAM_HEADER.size)
+        return header
+
+    index = bytes(data).find(LEGACY_SIGN)
+    if index == -1:
+        return None
+    return {'version': 0, 'key': bytes(data[:index]), 'length': index + len(LEGACY_SIGN)}
+
+def decryptStream(chunks, unwrap):
+    # Reads just enough of the envelope to unwrap the AES key, then yields
+    # plaintext segment by segment. Older envelopes are decrypted in one go.
+    chunks = iter(chunks)
+    buffer = b''
+    header = None
+    for chunk in chunks:
+        buffer += chunk
+        header = parseHeader(buffer)
+        if header is not None:
+            break
+    if header is None:
+        raise ValueError('Truncated envelope')
+
+    key = unwrap(header['key'])
+    if header['version'] == STREAM_VERSION:
+        aes = StreamAES(key, header['segment_size'], header['prefix'])
+        yield from aes.decrypt(chain([buffer[header['length']:]], chunks))
+    else:
+        _, body = unpackEnvelope(buffer + b''.join(chunks))
+        yield SelfAES().decrypt(body, key)
+
+def readHeader(fetch):
+    # fetch(start, stop) returns the bytes in [start, stop) and the total
+    # size of the envelope.
+    size = HEADER_PROBE_SIZE
+    while True:
+        data, total = fetch(0, size)
+        header = parseHeader(data)
+        if header is not None or size >= total:
+            return header, total
+        size *= 4
+
+def decryptRange(fetch, unwrap, offset, length):
+    # Unwraps the AES key once and decrypts only the segments that overlap
+    # [offset, offset + length) of the plaintext.
+    header, total = readHeader(fetch)
+    if header is None:
+        raise ValueError('Truncated envelope')
+
+    if header['version'] != STREAM_VERSION:
+        # Single-body envelopes can only be decrypted as a whole.
+        data, _ = fetch(0, total)
+        return b''.join(decryptStream([data], unwrap))[offset:offset + length]
+
+    aes = StreamAES(unwrap(header['key']), header['segment_size'], header['prefix'])
+    span = aes.segmentRange(offset, length, total - header['length'])
+    if span is None:
+        return b''
+
+    first, final, start, stop = span
+    data, _ = fetch(header['length'] + start, header['length'] + stop)
+    plaintext = b''.join(aes.decryptSegments(data, first, final))
+    skip = offset - first * aes.segment_size
+    return plaintext[skip:skip + length]
+
+def unpackEnvelope(data):
+    view = memoryview(data)
+    if len(view) >= ENVELOPE_HEADER.size and view[0] == ENVELOPE_VERSION:
+        _, length = ENVELOPE_HEADER.unpack_from(view)
+        end = ENVELOPE_HEADER.size + length
+        # Slices of the memoryview: the body is handed to AES without a copy.
+        return view[ENVELOPE_HEADER.size:end], view[end:]
+
+    # Legacy 'key_blob DEADBEEF base64(body)' records. Objects serialized by
+    # objectToBytes are base64 text, so they never start with the version byte.
+    key_blob, body = bytes(data).split(LEGACY_SIGN, 1)
+    return memoryview(key_blob), memoryview(b64decode(body))
+
 class SelfAES:
     def __init__(self):
         self.key = os.urandom(32)
@@ -27,21 +169,207 @@ class SelfAES:
     def getKey(self):
         return self.key
 
+class StreamAES:
+    def __init__(self, key=None, segment_size=SEGMENT_SIZE, prefix=None):
+        self.key = key if key is not None else os.urandom(32)
+        self.segment_size = segment_size
+        self.prefix = prefix if prefix is not None else os.urandom(7)
+
+    def getKey(self):
+        return self.key
+
+    def header(self, key_blob):
+        return ENVELOPE_HEADER.pack(STREAM_VERSION, len(key_blob)) + key_blob + \
+            STREAM_HEADER.pack(self.segment_size, self.prefix)
+
+    def _cipher(self, counter, last):
+        # nonce = prefix || segment counter || last-segment flag, so segments
+        # cannot be reordered, dropped from the end or spliced between files.
+        return AES.new(self.key, AES.MODE_GCM, nonce=self.prefix + struct.pack('>IB', counter, last))
+
+    def encrypt(self, stream):
+        counter = 0
+        segment = stream.read(self.segment_size)
+        while True:
+            following = stream.read(self.segment_size)
+            last = not following
+            ciphertext, tag = self._cipher(counter, last).encrypt_and_digest(segment)
+            yield ciphertext + tag
+            if last:
+                break
+            segment = following
+            counter += 1
+
+    def decrypt(self, chunks):
+        unit = self.segment_size + TAG_SIZE
+        buffer = bytearray()
+        counter = 0
+        for chunk in chunks:
+            buffer += chunk
+            # Keep anything up to one full unit back: only the end of the
+            # stream tells us which segment is the last one.
+            while len(buffer) > unit:
+                yield self._open(memoryview(buffer)[:unit], counter, False)
+                del buffer[:unit]
+                counter += 1
+
+        yield self._open(memoryview(buffer), counter, True)
+
+    def segmentRange(self, offset, length, body_size):
+        # Maps a plaintext range onto whole segments: returns the first
+        # segment, the final segment of the file and the [start, stop) byte
+        # span of the body to fetch, or None when the range is empty.
+        unit = self.segment_size + TAG_SIZE
+        final = max((body_size + unit - 1) // unit - 1, 0)
+        first = offset // self.segment_size
+        if offset < 0 or length <= 0 or first > final:
+            return None
+
+        last = min((offset + length - 1) // self.segment_size, final)
+        return first, final, first * unit, min((last + 1) * unit, body_size)
+
+    def decryptSegments(self, data, first, final):
+        # Decrypts consecutive segments starting at index 'first'; 'final' is
+        # the index of the file's last segment, needed for its nonce flag.
+        unit = self.segment_size + TAG_SIZE
+        view = memoryview(data)
+        for counter, start in enumerate(range(0, len(view), unit), first):
+            yield self._open(view[start:start + unit], counter, counter == final)
+
+    def _open(self, segment, counter, last):
+        if len(segment) < TAG_SIZE:
+            raise ValueError('Truncated segment')
+
+        return self._cipher(counter, last).decrypt_and_verify(segment[:-TAG_SIZE], segment[-TAG_SIZE:])
+
 class ABE:
     def __init__(self):
-        self.group = PairingGroup('SS512')
+        self.group = group
         self.cpabe = HybridABEnc(CPabe_BSW07(self.group), self.group)
-        self.sign = b'DEADBEEF'
+        self.sign = LEGACY_SIGN
 
     def encrypt(self, pk, msg, policy):
-        self.pk = bytesToObject(pk, self.group)
+        self.pk = loadPublicKey(pk)
         data = self.cpabe.encrypt(self.pk, msg, policy)
         
         return data
     
     def decrypt(self, pk, dk, ct):
-        self.pk = bytesToObject(pk, self.group)
+        self.pk = loadPublicKey(pk)
         self.dk = bytesToObject(dk, self.group)
         data = self.cpabe.decrypt(self.pk, self.dk, ct)
         
-        return data
\ No newline at end of file
+        return data
+
+    def precompute(self, pk):
+        # Everything in a BSW07 ciphertext that does not depend on the policy:
+        # the secret s, C = h^s, the blinded session key and g^s.
+        self.pk = loadPublicKey(pk)
+        s = self.group.random(ZR)
+        key = self.group.random(GT)
+
+        return {
+            's': s,
+            'key': key,
+            'C': self.pk['h'] ** s,
+            'C_tilde': (self.pk['e_gg_alpha'] ** s) * key,
+            'g_s': self.pk['g'] ** s
+        }
+
+    def encryptOnline(self, pk, msg, policy, pre=None):
+        if pre is None:
+            pre = self.precompute(pk)
+        self.pk = loadPublicKey(pk)
+
+        util = SecretUtil(self.group, verbose=False)
+        tree = util.createPolicy(policy)
+        shares = util.calculateSharesDict(pre['s'], tree)
+
+        C_y, C_y_pr = {}, {}
+        for i in shares:
+            j = util.strip_index(i)
+            # Leaves under OR gates receive s itself, so g^s is reused as is.
+            C_y[i] = pre['g_s'] if shares[i] == pre['s'] else self.pk['g'] ** shares[i]
+            C_y_pr[i] = self.group.hash(j, G2) ** shares[i]
+
+        c1 = {
+            'C_tilde': pre['C_tilde'], 'C': pre['C'], 'Cy': C_y, 'Cyp': C_y_pr,
+            'policy': policy, 'attributes': util.getAttributeList(tree)
+        }
+        c2 = AuthenticatedCryptoAbstraction(sha2(pre['key'])).encrypt(msg)
+
+        return {'c1': c1, 'c2': c2}
+
+class EncryptionPool:
+    def __init__(self, pk, size=OFFLINE_POOL_SIZE):
+        self.pk = pk
+        self.size = size
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        abe = ABE()
+        while not self.closed:
+            while len(self.items) < self.size and not self.closed:
+                item = abe.precompute(self.pk)
+                with self.lock:
+                    self.items.append(item)
+            self.wakeup.wait()
+            self.wakeup.clear()
+
+    def take(self):
+        # Precomputed material is handed out once and only ever kept in memory.
+        with self.lock:
+            item = self.items.popleft() if self.items else None
+        self.wakeup.set()
+
+        return item
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            self.items.clear()
+        self.wakeup.set()
+
+class CryptoContext:
+    # Everything a logged-in session needs to wrap and unwrap file keys:
+    # the scheme objects, the deserialized public and decryption keys and
+    # the offline encryption pool. Built once per login and warmed in the
+    # background, so each file only pays for its own ABE operation.
+    def __init__(self, pk, dk):
+        self.pk_bytes = pk
+        self.dk_bytes = dk
+        self.abe = ABE()
+        self.group = self.abe.group
+        self.lock = threading.Lock()
+        self.pk = None
+        self.dk = None
+        self.pool = None
+        self.thread = threading.Thread(target=self._load, daemon=True)
+        self.thread.start()
+
+    def _load(self):
+        with self.lock:
+            if self.pool is None:
+                self.pk = loadPublicKey(self.pk_bytes)
+                self.dk = bytesToObject(self.dk_bytes, self.group)
+                self.pool = EncryptionPool(self.pk)
+
+    def wrap(self, key, policy):
+        self._load()
+        enc_key = self.abe.encryptOnline(self.pk, key, policy, self.pool.take())
+
+        return objectToBytes(enc_key, self.group)
+
+    def unwrap(self, enc_key):
+        self._load()
+
+        return self.abe.cpabe.decrypt(self.pk, self.dk, bytesToObject(enc_key, self.group))
+
+    def close(self):
+        self._load()
+        self.pool.close()
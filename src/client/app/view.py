@@ -39,6 +39,9 @@ class Ui_ViewWindow(object):
         self.view_api_button = QPushButton(self.centralwidget)
         self.view_api_button.setObjectName(u"view_api_button")
         self.view_api_button.setGeometry(QRect(220, 300, 151, 61))
+        self.preview_api_button = QPushButton(self.centralwidget)
+        self.preview_api_button.setObjectName(u"preview_api_button")
+        self.preview_api_button.setGeometry(QRect(390, 300, 151, 61))
         MainWindow.setCentralWidget(self.centralwidget)
         self.menubar = QMenuBar(MainWindow)
         self.menubar.setObjectName(u"menubar")
@@ -66,5 +69,6 @@ class Ui_ViewWindow(object):
 
         self.UID.setPlaceholderText(QCoreApplication.translate("MainWindow", u"UID", None))
         self.view_api_button.setText(QCoreApplication.translate("MainWindow", u"VIEW", None))
+        self.preview_api_button.setText(QCoreApplication.translate("MainWindow", u"PREVIEW", None))
 
         self.back_button.setText(QCoreApplication.translate("ManiWindow", u"Back", None))
\ No newline at end of file
@@ -0,0 +1,42 @@
+from abe_core import group, precomputeTables
+from charm.toolbox.pairinggroup import GT
+from charm.schemes.abenc.abenc_bsw07 import CPabe_BSW07
+from charm.core.engine.util import objectToBytes, bytesToObject
+import sys
+import time
+
+SIZES = [1, 2, 4, 8, 16, 32]
+
+def measure(fn, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+
+    return (time.perf_counter() - start) / rounds
+
+def main(rounds=20):
+    cpabe = CPabe_BSW07(group)
+    pk, mk = cpabe.setup()
+    pk_bytes = objectToBytes(pk, group)
+    
+    # Same public key twice: once as the servers used to load it, once with
+    # the fixed-base tables built.
+    plain_pk = bytesToObject(pk_bytes, group)
+    table_pk = precomputeTables(bytesToObject(pk_bytes, group))
+    msg = group.random(GT)
+
+    print('{:<8} {:>5} {:>12} {:>12} {:>8}'.format('op', 'size', 'plain (ms)', 'tables (ms)', 'speedup'))
+    for size in SIZES:
+        attrs = ['ATTR{}'.format(i) for i in range(size)]
+        policy = ' or '.join(attrs)
+        ops = (
+            ('keygen', lambda pk: cpabe.keygen(pk, mk, attrs)),
+            ('encrypt', lambda pk: cpabe.encrypt(pk, msg, policy)),
+        )
+        for name, op in ops:
+            plain = measure(lambda: op(plain_pk), rounds)
+            table = measure(lambda: op(table_pk), rounds)
+            print('{:<8} {:>5} {:>12.2f} {:>12.2f} {:>7.2f}x'.format(name, size, plain * 1000, table * 1000, plain / table))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,277 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from getpass import getpass
+import argparse
+import requests
+import tempfile
+import threading
+import shutil
+import time
+import sys
+import csv
+import os
+
+from abe_core import StreamAES, ABE, loadPublicKey, objectToBytes
+from client_lib import Client, UPDATE_POLICIES, RETRY_BACKOFF, RETRY_STATUSES
+
+ENCRYPT_WORKERS = os.cpu_count()
+UPLOAD_CONCURRENCY = 8
+UPLOAD_RETRIES = 3
+REPORT_INTERVAL = 2.0
+# Batches are flushed at this many envelope bytes, well under the server's
+# limit; anything bigger is streamed on its own.
+BATCH_MAX_BYTES = 64 * 1024 * 1024
+BATCH_STATUSES = {'inserted': 'uploaded', 'duplicate': 'duplicate', 'rejected': 'failed'}
+MANIFEST_COLUMNS = ('uid', 'name', 'collection', 'path')
+
+def walkDirectory(root, collection_name):
+    # <root>/<patient name>/<uid>.<ext>
+    for dirpath, _, files in os.walk(root):
+        for name in sorted(files):
+            yield {
+                'uid': os.path.splitext(name)[0],
+                'patient_name': os.path.basename(dirpath),
+                'collection_name': collection_name,
+                'path': os.path.join(dirpath, name)
+            }
+
+def readManifest(path, collection_name):
+    # CSV with a header row; relative paths are taken from the manifest's folder.
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, newline='') as file:
+        for row in csv.DictReader(file):
+            yield {
+                'uid': row['uid'],
+                'patient_name': row['name'],
+                'collection_name': row.get('collection') or collection_name,
+                'path': os.path.join(base, row['path'])
+            }
+
+# Runs in the encryption processes. Each one loads the public key (and its
+# fixed-base tables) once, then spools envelopes to disk so uploads stream
+# from a file with a known length instead of pickling ciphertext back.
+worker = {}
+
+def initWorker(pk):
+    worker['abe'] = ABE()
+    worker['pk'] = loadPublicKey(pk)
+
+def encryptFile(path, policy, spool_dir):
+    aes = StreamAES() ; abe = worker['abe']
+    enc_key = objectToBytes(abe.encryptOnline(worker['pk'], aes.getKey(), policy), abe.group)
+
+    fd, enc_path = tempfile.mkstemp(dir=spool_dir)
+    with os.fdopen(fd, 'wb') as out, open(path, 'rb') as file:
+        out.write(aes.header(enc_key))
+        for segment in aes.encrypt(file):
+            out.write(segment)
+
+    return enc_path
+
+class Progress:
+    def __init__(self, total, stream=sys.stderr):
+        self.total = total
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.counts = {'uploaded': 0, 'duplicate': 0, 'failed': 0}
+        self.failures = []
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self.reported = 0
+
+    def finish(self, record, status, message=''):
+        with self.lock:
+            self.counts[status] += 1
+            if status == 'failed':
+                self.failures.append((record['path'], message))
+            elif os.path.isfile(record['path']):
+                self.bytes += os.path.getsize(record['path'])
+
+            now = time.perf_counter()
+            if now - self.reported >= REPORT_INTERVAL or self.done() == self.total:
+                self.reported = now
+                self.report()
+
+    def done(self):
+        return sum(self.counts.values())
+
+    def report(self):
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        print('\r[{}/{}] uploaded={uploaded} duplicate={duplicate} failed={failed}  {:.1f} records/s  {:.2f} MiB/s'.format(
+            self.done(), self.total, self.done() / elapsed, self.bytes / elapsed / 2**20, **self.counts),
+            end='', file=self.stream, flush=True)
+
+def recordParams(record):
+    return {
+        'collection_name': record['collection_name'],
+        'uid': record['uid'],
+        'patient_name': record['patient_name'],
+        'file_name': os.path.basename(record['path'])
+    }
+
+def uploadRecord(client, record, enc_path, update):
+    params = recordParams(record)
+
+    status, message = 'failed', ''
+    with open(enc_path, 'rb') as file:
+        for attempt in range(UPLOAD_RETRIES + 1):
+            if attempt:
+                time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+            file.seek(0)
+            try:
+                response = client.post_file(params, file, update)
+            except requests.ConnectionError as e:
+                message = str(e)
+                continue
+            if response.status_code in RETRY_STATUSES:
+                message = response.text
+                continue
+
+            if response.status_code == 200:
+                status, message = 'uploaded', ''
+            elif response.status_code == 409:
+                # Also what a retried request sees if an earlier attempt landed.
+                status, message = 'duplicate', ''
+            else:
+                message = response.json().get('error', response.text)
+            break
+
+    return status, message
+
+def uploadBatch(client, items):
+    # items: (record, enc_path) pairs of one collection. Returns one
+    # (status, message) per item.
+    collection_name = items[0][0]['collection_name']
+
+    message = ''
+    for attempt in range(UPLOAD_RETRIES + 1):
+        if attempt:
+            time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+        files = [open(enc_path, 'rb') for _, enc_path in items]
+        try:
+            response = client.post_batch(collection_name, [(recordParams(record), file) for (record, _), file in zip(items, files)])
+        except requests.ConnectionError as e:
+            message = str(e)
+            continue
+        finally:
+            for file in files:
+                file.close()
+        if response.status_code in RETRY_STATUSES:
+            message = response.text
+            continue
+
+        if response.status_code != 200:
+            message = response.json().get('error', response.text)
+            break
+        return [(BATCH_STATUSES[result['status']], result.get('error', '')) for result in response.json()['results']]
+
+    return [('failed', message)] * len(items)
+
+def run(client, records, workers=ENCRYPT_WORKERS, concurrency=UPLOAD_CONCURRENCY, update=False, batch_size=1):
+    records = list(records)
+    progress = Progress(len(records))
+    # Bounds how many envelopes are encrypted, queued for a batch or waiting
+    # on disk at once.
+    slots = threading.BoundedSemaphore(workers + (concurrency + len(UPDATE_POLICIES)) * batch_size)
+    spool_dir = tempfile.mkdtemp(prefix='bulk_upload_')
+    pending = {}
+    pending_lock = threading.Lock()
+
+    def upload(items):
+        try:
+            if len(items) == 1:
+                outcomes = [uploadRecord(client, items[0][0], items[0][1], update)]
+            else:
+                outcomes = uploadBatch(client, items)
+        except Exception as e:
+            outcomes = [('failed', str(e))] * len(items)
+        finally:
+            for _, enc_path in items:
+                os.remove(enc_path)
+                slots.release()
+        for (record, _), (status, message) in zip(items, outcomes):
+            progress.finish(record, status, message)
+
+    def queue(record, enc_path):
+        # Small envelopes are grouped per collection for the batch endpoint.
+        if batch_size == 1 or os.path.getsize(enc_path) >= BATCH_MAX_BYTES:
+            uploaders.submit(upload, [(record, enc_path)])
+            return
+        with pending_lock:
+            items = pending.setdefault(record['collection_name'], [])
+            items.append((record, enc_path))
+            if len(items) < batch_size and sum(os.path.getsize(path) for _, path in items) < BATCH_MAX_BYTES:
+                return
+            del pending[record['collection_name']]
+        uploaders.submit(upload, items)
+
+    def encrypted(job, record):
+        try:
+            enc_path = job.result()
+        except Exception as e:
+            slots.release()
+            progress.finish(record, 'failed', str(e))
+            return
+        queue(record, enc_path)
+
+    try:
+        with ThreadPoolExecutor(concurrency) as uploaders:
+            with ProcessPoolExecutor(workers, initializer=initWorker, initargs=(client.pk_key,)) as encryptors:
+                for record in records:
+                    if record['collection_name'] not in UPDATE_POLICIES:
+                        progress.finish(record, 'failed', 'Invalid collection name')
+                        continue
+                    if not os.path.isfile(record['path']):
+                        progress.finish(record, 'failed', 'The file is not exist')
+                        continue
+
+                    slots.acquire()
+                    policy = client.policy_for(record['collection_name'], record['uid'])
+                    job = encryptors.submit(encryptFile, record['path'], policy, spool_dir)
+                    job.add_done_callback(lambda job, record=record: encrypted(job, record))
+
+            # Every encryption callback has run once the process pool is shut down.
+            for items in pending.values():
+                uploaders.submit(upload, items)
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+    if records:
+        print(file=progress.stream)
+    return progress
+
+def main():
+    parser = argparse.ArgumentParser(description='Encrypt and upload patient records in bulk.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--dir', help='folder laid out as <patient name>/<uid>.<ext>')
+    source.add_argument('--manifest', help='CSV with columns ' + ', '.join(MANIFEST_COLUMNS))
+    parser.add_argument('-u', '--username', required=True)
+    parser.add_argument('-p', '--password', help='prompted for when omitted')
+    parser.add_argument('-c', '--collection', default='health_record', choices=sorted(UPDATE_POLICIES),
+                        help='collection for directory walks and manifest rows without one')
+    parser.add_argument('--update', action='store_true', help='replace existing records instead of adding new ones')
+    parser.add_argument('--workers', type=int, default=ENCRYPT_WORKERS, help='encryption processes')
+    parser.add_argument('--concurrency', type=int, default=UPLOAD_CONCURRENCY, help='uploads in flight')
+    parser.add_argument('--batch-size', type=int, default=1, help='records per request to the batch endpoint')
+    args = parser.parse_args()
+    if args.update and args.batch_size > 1:
+        parser.error('--update sends records one at a time')
+
+    client = Client(pool_size=args.concurrency)
+    ok, data = client.login(args.username, args.password or getpass())
+    if not ok:
+        sys.exit(data)
+    client.crypto.close()
+
+    if args.dir:
+        records = walkDirectory(args.dir, args.collection)
+    else:
+        records = readManifest(args.manifest, args.collection)
+
+    progress = run(client, records, args.workers, args.concurrency, args.update, args.batch_size)
+    for path, message in progress.failures:
+        print('FAILED {}: {}'.format(path, message), file=sys.stderr)
+
+    sys.exit(1 if progress.failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urljoin
+from itertools import chain
+import requests
+import hashlib
+import json
+import os
+
+from abe_core import StreamAES, CryptoContext, readHeader, decryptStream, decryptRange
+
+TRUSTED_AUTHORITY = "http://localhost:5000"
+CLOUD_DOMAIN = "http://localhost:8000"
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Connection pool per host and retry policy of the shared session. Only
+# connection failures and idempotent requests are retried here: a streamed
+# upload body cannot be replayed, so callers retry those themselves. Once
+# retries run out the last response is returned, not raised as a RetryError.
+POOL_SIZE = 16
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = (502, 503, 504)
+
+# Record fields of streamed uploads go in this JSON header, keeping
+# patient names out of the URL and so out of server and proxy logs.
+METADATA_HEADER = 'X-Record-Metadata'
+
+UPDATE_POLICIES = {
+    'health_record': ['doctor', 'nurse', 'patient'],
+    'medicine_record': ['doctor', 'pharmacist', 'patient'],
+    'financial_record': ['financial'],
+    'research_record': ['doctor', 'researcher'],
+}
+
+class Cancelled(Exception):
+    # Raised by a progress callback to stop an upload or download.
+    pass
+
+def makeSession(pool_size=POOL_SIZE):
+    retry = Retry(total=RETRY_TOTAL, backoff_factor=RETRY_BACKOFF, status_forcelist=RETRY_STATUSES, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+def errorMessage(response):
+    # Proxies answer gateway errors with HTML, not the API's JSON.
+    try:
+        return response.json()['error']
+    except (ValueError, KeyError, TypeError):
+        return response.text or response.reason
+
+class Client:
+    def __init__(self, trusted_authority=TRUSTED_AUTHORITY, cloud_domain=CLOUD_DOMAIN, pool_size=POOL_SIZE):
+        self.trusted_authority = trusted_authority
+        self.cloud_domain = cloud_domain
+        self.session = makeSession(pool_size)
+        self.token = None
+
+    def login(self, username, password):
+        data = {
+            'username': username,
+            'password': password
+        }
+        # One round-trip: the trusted server logs in, derives the key
+        # attributes and returns the token together with the keys.
+        response = self.session.post(urljoin(self.trusted_authority, '/bootstrap'), data=data)
+
+        if response.status_code != 200:
+            return False, response.text
+
+        data = response.json()
+        self.uid = str(data['ID'])
+        self.init_keys(data)
+
+        return True, data
+
+    def init_keys(self, data):
+        self.token = data['token']
+        self.attribute = data['key_attribute']
+        self.dk_key = data['dk_key']
+        self.pk_key = data['pk_key']
+        self.crypto = CryptoContext(self.pk_key, self.dk_key)
+
+    def headers(self):
+        return {'Authorization': self.token}
+
+    def search(self, query, cursor=None):
+        data = dict(query, cursor=cursor)
+        response = self.session.post(urljoin(self.cloud_domain, '/api/search_record'), json=data, headers=self.headers())
+
+        data = response.json()
+        if response.status_code != 200:
+            return False, data['error']
+
+        return True, data
+
+    def view(self, collection_name, uid):
+        data = {
+            'uid': uid,
+            'collection_name': collection_name
+        }
+        response = self.session.post(urljoin(self.cloud_domain, '/api/view_patient_record'), json=data, headers=self.headers())
+
+        data = response.json()
+        if response.status_code != 200:
+            return False, data['error']
+
+        return True, data['patient_data']
+
+    def policy_for(self, collection_name, uid):
+        user_attr = [attr.lower() for attr in self.attribute]
+
+        return self.convert_policy(UPDATE_POLICIES[collection_name], user_attr, uid)
+
+    def convert_policy(self, policy, user_attr, text):
+
+        final_policy = []
+        for p in policy:
+            tmp = 0
+            for p2 in user_attr:
+                if p in p2:
+                    final_policy.append(p2)
+                    tmp = 1
+                    continue
+            if p == 'patient':
+                p = "{}_{}".format(p, text)
+            if tmp == 0:
+                final_policy.append(p)
+
+        final_policy = [p.replace('_', '').lower() for p in list(set(final_policy))]
+        final_policy = ' or '.join(final_policy)
+
+        return final_policy
+
+    def post_file(self, params, body, update=False):
+        # body is either a generator of envelope pieces or an already
+        # encrypted file object, which requests sends with a Content-Length.
+        endpoint = '/api/update_patient_file' if update else '/api/upload_patient_file'
+        metadata = dict(params)
+        query = {'collection_name': metadata.pop('collection_name')}
+        headers = dict(self.headers())
+        headers[METADATA_HEADER] = json.dumps(metadata)
+
+        return self.session.post(urljoin(self.cloud_domain, endpoint), params=query, data=body, headers=headers)
+
+    def post_batch(self, collection_name, items):
+        # items: (params, file) pairs, sent as one multipart request to the
+        # batch endpoint. requests builds the body in memory, so callers keep
+        # batches small.
+        records, files = [], []
+        for i, (params, file) in enumerate(items):
+            part = 'file{}'.format(i)
+            records.append(dict(params, file=part))
+            files.append((part, (params['file_name'], file, 'application/octet-stream')))
+
+        return self.session.post(urljoin(self.cloud_domain, '/api/upload_patient_records_batch'), params={'collection_name': collection_name},
+                                 data={'records': json.dumps(records)}, files=files, headers=self.headers())
+
+    def upload_file(self, collection_name, uid, patient_name, path, update=False, progress=None):
+        # progress(done, total) is called with plaintext bytes read so far.
+        params = {
+            'collection_name': collection_name,
+            'uid': uid,
+            'patient_name': patient_name,
+            'file_name': os.path.basename(path)
+        }
+        total = os.path.getsize(path)
+        with open(path, 'rb') as file:
+            enc_data = self.encrypt_phase(self.policy_for(collection_name, uid), file)
+            if progress is not None:
+                enc_data = self.track(enc_data, file, total, progress)
+            try:
+                response = self.post_file(params, enc_data, update)
+            except Cancelled:
+                return False, "Cancelled"
+
+        data = response.json()
+        if response.status_code != 200:
+            return False, data['error']
+
+        return True, data['message']
+
+    def track(self, chunks, file, total, progress):
+        for chunk in chunks:
+            yield chunk
+            progress(min(file.tell(), total), total)
+
+    def can_update(self, collection_name, uid):
+        # Only the ABE-wrapped key is needed to prove access.
+        ok, data = self.view(collection_name, uid)
+        if not ok:
+            return False, data
+        if data == []:
+            return False, "There's no data with the provided UID."
+
+        enc_key = self.download_key(collection_name, data[0]['uid'])
+        if enc_key is None or self.decrypt_key(enc_key) is False:
+            return False, "You don't have permission to update the data!"
+
+        return True, "SUCCESS"
+
+    def open_download(self, collection_name, uid, start=None, stop=None):
+        headers = self.headers()
+        if start is not None:
+            headers['Range'] = 'bytes={}-{}'.format(start, stop - 1)
+        params = {
+            'uid': uid,
+            'collection_name': collection_name
+        }
+
+        return self.session.get(urljoin(self.cloud_domain, '/api/download_patient_file'), params=params, headers=headers, stream=True)
+
+    def fetch_range(self, collection_name, uid):
+        # Returns fetch(start, stop) -> (data, total) for decryptRange/readHeader.
+        def fetch(start, stop):
+            with self.open_download(collection_name, uid, start, stop) as response:
+                if response.status_code == 206:
+                    return response.content, int(response.headers['Content-Range'].rsplit('/', 1)[1])
+                if response.status_code == 200:
+                    # Server ignored the Range header.
+                    return response.content[start:stop], len(response.content)
+                if response.status_code == 416:
+                    return b'', int(response.headers['Content-Range'].rsplit('/', 1)[1])
+                raise LookupError(errorMessage(response))
+
+        return fetch
+
+    def download_file(self, collection_name, patient_data, path, progress=None):
+        response = self.open_download(collection_name, patient_data['uid'])
+        if response.status_code != 200:
+            message = errorMessage(response)
+            response.close()
+            return False, message
+
+        digest = hashlib.sha256()
+        total = int(response.headers.get('Content-Length', 0))
+        def chunks():
+            done = 0
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+                done += len(chunk)
+                if progress is not None:
+                    progress(done, total)
+                yield chunk
+
+        # Plaintext goes straight from the network to disk, one segment at a time.
+        plain, msg = False, "Failed to decrypt the data. Please try again"
+        try:
+            with open(path, 'wb') as file:
+                for segment in self.decrypt_phase(chunks()):
+                    file.write(segment)
+            if digest.hexdigest() == patient_data.get('file_hash', digest.hexdigest()):
+                plain, msg = True, "SUCCESS"
+            else:
+                msg = "The downloaded attachment is corrupted. Please try again"
+        except PermissionError as e:
+            msg = str(e)
+        except Cancelled:
+            msg = "Cancelled"
+        except ValueError:
+            pass
+        finally:
+            response.close()
+
+        if not plain and os.path.exists(path):
+            os.remove(path)
+
+        return plain, msg
+
+    def download_key(self, collection_name, uid):
+        # Only the envelope header is requested, whatever the record's size.
+        try:
+            header, _ = readHeader(self.fetch_range(collection_name, uid))
+        except LookupError:
+            return None
+
+        return header['key'] if header is not None else None
+
+    def decrypt_range(self, collection_name, uid, offset, length):
+        # Only the header and the segments covering the range are fetched.
+        try:
+            return True, decryptRange(self.fetch_range(collection_name, uid), self.unwrap_key, offset, length)
+        except (LookupError, PermissionError) as e:
+            return False, str(e)
+        except ValueError:
+            return False, "Failed to decrypt the data. Please try again"
+
+    def decrypt_key(self, enc_key):
+        try:
+            return self.crypto.unwrap(enc_key)
+        except:
+            return False
+
+    def encrypt_phase(self, final_policy, file):
+        aes = StreamAES()
+        enc_key = self.crypto.wrap(aes.getKey(), final_policy)
+
+        # Lazily encrypted: requests pulls one segment at a time from the file.
+        return chain([aes.header(enc_key)], aes.encrypt(file))
+
+    def unwrap_key(self, enc_key):
+        key = self.decrypt_key(enc_key)
+        if key is False:
+            raise PermissionError("You don't have permission to decrypt the data!")
+
+        return key
+
+    def decrypt_phase(self, chunks):
+        return decryptStream(chunks, self.unwrap_key)
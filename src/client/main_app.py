@@ -1,119 +1,153 @@
-from PyQt5.QtWidgets import QApplication, QMainWindow, QMessageBox, QDialog, QTableWidget, QTableWidgetItem, QVBoxLayout
-from PyQt5.QtCore import pyqtSlot
+from PyQt5.QtWidgets import QApplication, QMainWindow, QMessageBox, QDialog, QTableWidget, QTableWidgetItem, QVBoxLayout, QPushButton, QDockWidget, QPlainTextEdit
+from PyQt5.QtCore import pyqtSlot, Qt
 from app.login import Ui_LoginWindow
 from app.menu import Ui_MenuWindow
 from app.search import Ui_SearchWindow
 from app.push_data import Ui_PushWindow
 from app.update_data import Ui_UpdateWindow
 from app.view import Ui_ViewWindow
-from urllib.parse import urljoin
-import requests
 import os
 
-from abe_core import SelfAES, ABE, objectToBytes, bytesToObject
-from base64 import b64encode, b64decode
+from client_lib import Client
+from workers import Task, TaskRunner, TaskList
 
-TRUSTED_AUTHORITY = "http://localhost:5000" 
-CLOUD_DOMAIN = "http://localhost:8000"
-
-session = requests.Session()
+SEARCH_PAGE_SIZE = 50
+SEARCH_COLUMNS = ['uid', 'patient_name']
+TASK_DOCK_HEIGHT = 160
+PREVIEW_SIZE = 64 * 1024
 
 class MainWindow(QMainWindow, Ui_LoginWindow):
     def __init__(self):
         super(MainWindow, self).__init__()
         self.setupUi(self)
+        self.client = Client()
+        self.runner = TaskRunner()
+        self.tasks_dock = None
+
+    def start_task(self, name, fn, on_done, *args, listed=True):
+        # Network and crypto work runs on the pool; on_done gets the result
+        # back on the GUI thread. Listed tasks show up in the task dock.
+        task = Task(name, fn, *args)
+        if listed:
+            self.show_tasks()
+            self.task_list.add(task)
+        task.signals.finished.connect(lambda result: task.cancelled() or on_done(result))
+        task.signals.error.connect(lambda message: task.cancelled() or self.popup(message))
+
+        return self.runner.start(task)
+
+    def show_tasks(self):
+        if self.tasks_dock is None:
+            self.task_list = TaskList()
+            self.tasks_dock = QDockWidget("Tasks", self)
+            self.tasks_dock.setFeatures(QDockWidget.NoDockWidgetFeatures)
+            self.tasks_dock.setWidget(self.task_list)
+            self.tasks_dock.setFixedHeight(TASK_DOCK_HEIGHT)
+            self.addDockWidget(Qt.BottomDockWidgetArea, self.tasks_dock)
+            self.resize(self.width(), self.height() + TASK_DOCK_HEIGHT)
+
+    def setup_screen(self, ui):
+        # Every screen resizes the window for itself; keep room for the dock.
+        ui.setupUi(self)
+        if self.tasks_dock is not None:
+            self.resize(self.width(), self.height() + TASK_DOCK_HEIGHT)
+
+        return ui
+
+    def closeEvent(self, event):
+        self.runner.cancel_all()
+        super(MainWindow, self).closeEvent(event)
 
     @pyqtSlot()
     def on_pushButton_clicked(self):
         username = self.username_textbox.text()
         password = self.password_textbox.text()
 
-        data = {
-            'username': username,
-            'password': password
-        }
-        response = session.post(urljoin(TRUSTED_AUTHORITY, '/login'), data=data)
+        self.start_task("Login", lambda task: self.client.login(username, password), self.logged_in, listed=False)
 
-        if response.status_code == 200:
-            data = response.json()
-            
-            self.uid_text = str(data['ID'])
+    def logged_in(self, result):
+        ok, data = result
+        if ok:
+            self.uid_text = self.client.uid
             
             self.show_menu()
-            self.init_keys(data)
         else:
-            self.popup(response.text)
+            self.popup(data)
 
     def show_menu(self):
-        w = Ui_MenuWindow()
-        w.setupUi(self)
+        w = self.setup_screen(Ui_MenuWindow())
         w.text_label.setText("UID: " + self.uid_text)
         
-    def init_keys(self, data):
-        response = session.post(urljoin(TRUSTED_AUTHORITY, '/token'), json=data)
-        self.token = response.text
-        self.attribute = data['attribute']
-        
-        temp = []
-        for attr in self.attribute:
-            if attr == 'patient':
-                temp.append('PATIENT'+str(data['ID']))
-            else:
-                temp.append(attr)
-        self.attribute = [attr.upper().replace('_', '') for attr in temp]
-        
-        response = session.post(urljoin(TRUSTED_AUTHORITY, '/get_keys'), json={'attribute': str(self.attribute)})
-        keys = response.json()
-        self.dk_key = keys['dk_key']
-        self.pk_key = keys['pk_key']
-
-
     @pyqtSlot()
     def on_search_button_clicked(self):
         self.show_search()
     
     def show_search(self):
-        w = Ui_SearchWindow()
-        w.setupUi(self)
+        w = self.setup_screen(Ui_SearchWindow())
         self.search_combo_box = w.combo_box
         self.search_userid = w.userid_textbox
         self.search_name = w.name_textbox
     
     @pyqtSlot()
     def on_search_api_button_clicked(self):
-        headers = {'Authorization': self.token}
-        data = {
+        self.search_query = {
             'uid': self.search_userid.text(),
             'patient_name': self.search_name.text(),
-            'collection_name': self.search_combo_box.currentText()
+            'collection_name': self.search_combo_box.currentText(),
+            'limit': SEARCH_PAGE_SIZE
         }
         
-        response = session.post(urljoin(CLOUD_DOMAIN, '/api/search_record'), json=data, headers=headers)
-    
-        data = response.json()
-        if response.status_code != 200:
-            self.popup(data['error'])
+        self.search_page(None, self.search_done)
+
+    def search_done(self, data):
+        if data['results'] == []:
+            self.popup("There's no data matching the search.")
         else:
             self.popup_table(data)
+
+    def search_page(self, cursor, on_page):
+        # The total is only needed for the first page's title; later pages
+        # skip the count_documents it costs.
+        query = dict(self.search_query, with_count=cursor is None)
+
+        def done(result):
+            ok, data = result
+            if not ok:
+                self.popup(data)
+            else:
+                on_page(data)
+        
+        self.start_task("Search", lambda task: self.client.search(query, cursor), done, listed=False)
         
     def popup_table(self, data):
         window = QDialog(self)
-        window.setWindowTitle("Search Results")
+        window.setWindowTitle("Search Results ({} found)".format(data['total']))
 
         table = QTableWidget()
-        table.setColumnCount(len(data[0])) 
-        table.setRowCount(len(data))
+        table.setColumnCount(len(SEARCH_COLUMNS)) 
+        table.setHorizontalHeaderLabels(SEARCH_COLUMNS)
+        next_button = QPushButton("Next page")
+
+        def show_page(page):
+            # Only one page of rows is ever held by the table.
+            table.setRowCount(len(page['results']))
+            for row_num, row_data in enumerate(page['results']):
+                for col_num, column in enumerate(SEARCH_COLUMNS):
+                    item = QTableWidgetItem(str(row_data.get(column, '')))
+                    table.setItem(row_num, col_num, item)
+            window.next_cursor = page['next_cursor']
+            next_button.setEnabled(page['next_cursor'] is not None)
 
-        headers = list(data[0].keys())
-        table.setHorizontalHeaderLabels(headers)
+        def next_page():
+            next_button.setEnabled(False)
+            self.search_page(window.next_cursor, show_page)
 
-        for row_num, row_data in enumerate(data):
-            for col_num, col_data in enumerate(row_data.values()):
-                item = QTableWidgetItem(str(col_data))
-                table.setItem(row_num, col_num, item)
+        next_button.clicked.connect(next_page)
+        show_page(data)
 
         layout = QVBoxLayout()
         layout.addWidget(table)
+        layout.addWidget(next_button)
         window.setLayout(layout)
         window.exec()
  
@@ -122,60 +156,95 @@ class MainWindow(QMainWindow, Ui_LoginWindow):
         self.show_view()
     
     def show_view(self):
-        w = Ui_ViewWindow()
-        w.setupUi(self)
+        w = self.setup_screen(Ui_ViewWindow())
         self.view_uid = w.UID
         self.view_combo_box = w.collection
     
     @pyqtSlot()
     def on_view_api_button_clicked(self):
-        headers = {'Authorization': self.token}
-        data = {
-            'uid': self.view_uid.text(),
-            'collection_name': self.view_combo_box.currentText()
-        }
-        response = session.post(urljoin(CLOUD_DOMAIN, '/api/view_patient_record'), json=data, headers=headers)
+        collection_name = self.view_combo_box.currentText()
+        uid = self.view_uid.text()
+
+        def view(task):
+            ok, data = self.client.view(collection_name, uid)
+            if not ok or data == []:
+                return ok, data, None
+
+            patient_data = data[0]
+            
+            DOWNLOAD_PATH = './download/'
+            plain, msg = self.client.download_file(collection_name, patient_data, DOWNLOAD_PATH+patient_data['file_name'], progress=task.report)
+            return plain, msg, patient_data
         
-        data = response.json()
-        if response.status_code != 200:
-            self.popup(data['error'])
+        self.start_task("Download {} {}".format(collection_name, uid), view, self.view_done)
+
+    @pyqtSlot()
+    def on_preview_api_button_clicked(self):
+        collection_name = self.view_combo_box.currentText()
+        uid = self.view_uid.text()
+
+        def preview(task):
+            ok, data = self.client.view(collection_name, uid)
+            if not ok or data == []:
+                return ok, data, None
+
+            # Only the segments holding the first PREVIEW_SIZE bytes are
+            # downloaded and decrypted, whatever the attachment's size.
+            patient_data = data[0]
+            ok, plain = self.client.decrypt_range(collection_name, patient_data['uid'], 0, PREVIEW_SIZE)
+            return ok, plain, patient_data
+
+        self.start_task("Preview {} {}".format(collection_name, uid), preview, self.preview_done)
+
+    def preview_done(self, result):
+        ok, plain, patient_data = result
+        if patient_data is None:
+            if plain == []:
+                self.popup("There's no data with the provided UID.\nPlease generate a profile for it.")
+            else:
+                self.popup(plain)
+        elif ok:
+            self.popup_preview(patient_data, plain)
         else:
-            try:
-                if data['patient_data'] == []:
-                    raise Exception('None')
-
-                patient_data = data['patient_data'][0]
-                
-                enc_data = patient_data['file_data'].encode()
-                plain, msg = self.decrypt_phase(enc_data)
-                
-                if plain:
-                    DOWNLOAD_PATH = './download/'
-                    file_name = patient_data['file_name']
-                    with open(DOWNLOAD_PATH+file_name, 'wb') as file:
-                        file.write(plain)  
-                        
-                    msg = "UID: " + patient_data['uid'] + '\n' + \
-                        "Patient Name: " + patient_data['patient_name'] + '\n' + \
-                        "Attachment Name: " + patient_data['file_name'] + \
-                        '\nThe attachment has been downloaded successfully in "download/"'
-                            
-                    self.popup(msg, title="SUCCESS")
-                elif plain == False:
-                    self.popup(msg)
-            except Exception as e:
-                if str(e) == 'None':
-                    self.popup("There's no data with the provided UID.\nPlease generate a profile for it.")    
-                else:
-                    print(e)
+            self.popup(plain)
+
+    def popup_preview(self, patient_data, plain):
+        window = QDialog(self)
+        window.setWindowTitle("{} ({} - first {} KiB)".format(patient_data['file_name'], patient_data['patient_name'], PREVIEW_SIZE // 1024))
+
+        text = QPlainTextEdit()
+        text.setReadOnly(True)
+        text.setPlainText(plain.decode('utf-8', errors='replace'))
+
+        layout = QVBoxLayout()
+        layout.addWidget(text)
+        window.setLayout(layout)
+        window.resize(640, 480)
+        window.exec()
+
+    def view_done(self, result):
+        plain, msg, patient_data = result
+        if patient_data is None:
+            if msg == []:
+                self.popup("There's no data with the provided UID.\nPlease generate a profile for it.")
+            else:
+                self.popup(msg)
+        elif plain:
+            msg = "UID: " + patient_data['uid'] + '\n' + \
+                "Patient Name: " + patient_data['patient_name'] + '\n' + \
+                "Attachment Name: " + patient_data['file_name'] + \
+                '\nThe attachment has been downloaded successfully in "download/"'
+                    
+            self.popup(msg, title="SUCCESS")
+        else:
+            self.popup(msg)
                     
     @pyqtSlot()
     def on_upload_button_clicked(self):
         self.show_push()
     
     def show_push(self):
-        w = Ui_PushWindow()
-        w.setupUi(self)
+        w = self.setup_screen(Ui_PushWindow())
         self.push_uid = w.UID
         self.push_name = w.NAME
         self.file_name = w.FileName
@@ -184,40 +253,10 @@ class MainWindow(QMainWindow, Ui_LoginWindow):
     @pyqtSlot()
     def on_push_button_clicked(self):
         if os.path.isfile(self.file_name.text()):
-            headers = {'Authorization': self.token}
-            
-            UPDATE_POLICIES = {
-                'health_record': ['doctor', 'nurse', 'patient'],
-                'medicine_record': ['doctor', 'pharmacist', 'patient'],
-                'financial_record': ['financial'],
-                'research_record': ['doctor', 'researcher'],
-            }    
-                    
-            POLICY = UPDATE_POLICIES[self.combo_box.currentText()]        
-            user_attr = [attr.lower() for attr in self.attribute]
-            final_policy = self.convert_policy(POLICY, user_attr, self.push_uid.text())
+            args = (self.combo_box.currentText(), self.push_uid.text(), self.push_name.text(), self.file_name.text())
             
-            with open(self.file_name.text(), 'rb') as file:
-                file_data = file.read()
-            enc_data = self.encrypt_phase(final_policy, file_data)
-            
-            patient_data = {
-                'uid': self.push_uid.text(),
-                'patient_name': self.push_name.text(),
-                'file_name': self.file_name.text().split('/')[-1],
-                'file_data': enc_data.decode()
-            }
-            data = {
-                'collection_name': self.combo_box.currentText(),
-                'patient_data': patient_data
-            }
-            response = session.post(urljoin(CLOUD_DOMAIN, '/api/upload_patient_record'), json=data, headers=headers)
-            
-            data = response.json()
-            if response.status_code != 200:
-                self.popup(data['error'])
-            else:
-                self.popup(data['message'], title="SUCCESS")
+            self.start_task("Upload {} {}".format(args[0], args[1]),
+                            lambda task: self.client.upload_file(*args, progress=task.report), self.upload_done)
         else:
             self.popup("The file is not exist.\nPlease check the path again!")
     
@@ -227,8 +266,7 @@ class MainWindow(QMainWindow, Ui_LoginWindow):
         self.show_update()
 
     def show_update(self):
-        w = Ui_UpdateWindow()
-        w.setupUi(self)
+        w = self.setup_screen(Ui_UpdateWindow())
         self.update_uid = w.UID
         self.update_name = w.NAME
         self.update_file_name = w.FileName
@@ -237,110 +275,26 @@ class MainWindow(QMainWindow, Ui_LoginWindow):
     @pyqtSlot()
     def on_update_api_button_clicked(self):
         if os.path.isfile(self.update_file_name.text()):
-            headers = {'Authorization': self.token}
-            
-            # Decrypt data to check if user be able to update
-            
-            data = {
-                'uid': self.update_uid.text(),
-                'collection_name': self.update_combo_box.currentText()
-            }
-            response = session.post(urljoin(CLOUD_DOMAIN, '/api/view_patient_record'), json=data, headers=headers)
+            args = (self.update_combo_box.currentText(), self.update_uid.text(), self.update_name.text(), self.update_file_name.text())
+
+            def update(task):
+                # Decrypt data to check if user be able to update
+                ok, msg = self.client.can_update(args[0], args[1])
+                if ok:
+                    # Encrypt data to Update
+                    ok, msg = self.client.upload_file(*args, update=True, progress=task.report)
+                return ok, msg
             
-            data = response.json()
-            if response.status_code != 200:
-                self.popup(data['error'])
-            else:
-                patient_data = data['patient_data'][0]
-        
-                enc_data = patient_data['file_data'].encode()
-                plain, msg = self.decrypt_phase(enc_data)
-                if plain is not False:
-
-                # Encrypt data to Update
-                
-                    UPDATE_POLICIES = {
-                        'health_record': ['doctor', 'nurse', 'patient'],
-                        'medicine_record': ['doctor', 'pharmacist', 'patient'],
-                        'financial_record': ['financial'],
-                        'research_record': ['doctor', 'researcher'],
-                    }    
-                    
-                    POLICY = UPDATE_POLICIES[self.update_combo_box.currentText()]        
-                    user_attr = [attr.lower() for attr in self.attribute]
-                    final_policy = self.convert_policy(POLICY, user_attr, self.update_uid.text())
-                    
-                    with open(self.update_file_name.text(), 'rb') as file:
-                        file_data = file.read()
-                    enc_data = self.encrypt_phase(final_policy, file_data)
-                    
-                    patient_data = {
-                        'uid': self.update_uid.text(),
-                        'patient_name': self.update_name.text(),
-                        'file_name': self.update_file_name.text().split('/')[-1],
-                        'file_data': enc_data.decode()
-                    }
-                    data = {
-                        'collection_name': self.update_combo_box.currentText(),
-                        'updated_data': patient_data
-                    }
-                    response = session.post(urljoin(CLOUD_DOMAIN, '/api/update_patient_record'), json=data, headers=headers)
-                    
-                    data = response.json()
-                    if response.status_code != 200:
-                        self.popup(data['error'])
-                    else:
-                        self.popup(data['message'], title="SUCCESS")
-                else:
-                    self.popup("You don't have permission to update the data!")
+            self.start_task("Update {} {}".format(args[0], args[1]), update, self.upload_done)
         else:
             self.popup("The file is not exist.\nPlease check the path again!")
-    
-    def convert_policy(self, policy, user_attr, text):
-
-        final_policy = []
-        for p in policy:
-            tmp = 0
-            for p2 in user_attr:
-                if p in p2:
-                    final_policy.append(p2)
-                    tmp = 1
-                    continue
-            if p == 'patient':
-                p = "{}_{}".format(p, text)
-            if tmp == 0:
-                final_policy.append(p)       
-
-        final_policy = [p.replace('_', '').lower() for p in list(set(final_policy))]
-        final_policy = ' or '.join(final_policy)
-        
-        return final_policy
-    
-    def encrypt_phase(self, final_policy, file_data):
-        aes = SelfAES() ; abe = ABE()
-        enc = b64encode(aes.encrypt(file_data))
-        key = aes.getKey()
-        enc_key = abe.encrypt(self.pk_key, key, final_policy)
-        enc_key = objectToBytes(enc_key, abe.group)
-        enc_data = enc_key + abe.sign + enc
-        
-        return enc_data
-    
-    def decrypt_phase(self, enc_data):
-        aes = SelfAES(); abe = ABE()
-        enc_key = enc_data.split(abe.sign)[0]
-        enc = enc_data.split(abe.sign)[1]
-        enc_key = bytesToObject(enc_key, abe.group)
-        
-        try:
-            enc_key = abe.decrypt(self.pk_key, self.dk_key, enc_key)
-            try:
-                plain = aes.decrypt(b64decode(enc), enc_key)   
-                return plain, "SUCCESS"
-            except:
-                return False, "Failed to decrypt the data. Please try again"
-        except:
-            return False, "You don't have permission to decrypt the data!"
+
+    def upload_done(self, result):
+        ok, msg = result
+        if not ok:
+            self.popup(msg)
+        else:
+            self.popup(msg, title="SUCCESS")
             
     
     @pyqtSlot()
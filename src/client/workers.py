@@ -0,0 +1,114 @@
+from PyQt5.QtWidgets import QTableWidget, QTableWidgetItem, QPushButton, QHeaderView
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal, pyqtSlot
+import threading
+
+from client_lib import Cancelled
+
+TASK_THREADS = 4
+TASK_LIST_ROWS = 20
+TASK_COLUMNS = ['Task', 'Status', '']
+
+class TaskSignals(QObject):
+    # Created on the GUI thread, so slots connected to these run there even
+    # though the task emits them from a pool thread.
+    progress = pyqtSignal(int)
+    finished = pyqtSignal(object)
+    error = pyqtSignal(str)
+
+class Task(QRunnable):
+    def __init__(self, name, fn, *args):
+        super(Task, self).__init__()
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.signals = TaskSignals()
+        self.cancel_event = threading.Event()
+        self.percent = -1
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def report(self, done, total):
+        # Progress callback for client_lib: it is also where a cancelled task
+        # stops, at the next chunk boundary.
+        if self.cancelled():
+            raise Cancelled()
+        percent = 100 * done // total if total else 0
+        if percent != self.percent:
+            self.percent = percent
+            self.signals.progress.emit(percent)
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            if self.cancelled():
+                raise Cancelled()
+            result = self.fn(self, *self.args)
+        except Cancelled:
+            self.signals.error.emit("Cancelled")
+        except Exception as e:
+            self.signals.error.emit(str(e))
+        else:
+            self.signals.finished.emit(result)
+
+class TaskRunner:
+    def __init__(self, max_threads=TASK_THREADS):
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(max_threads)
+        # Python keeps the tasks alive until they are done; Qt must not
+        # delete them behind the signals' back.
+        self.running = set()
+
+    def start(self, task):
+        self.running.add(task)
+        task.signals.finished.connect(lambda _: self.running.discard(task))
+        task.signals.error.connect(lambda _: self.running.discard(task))
+        task.setAutoDelete(False)
+        self.pool.start(task)
+
+        return task
+
+    def cancel_all(self):
+        for task in list(self.running):
+            task.cancel()
+
+class TaskList(QTableWidget):
+    def __init__(self, parent=None):
+        super(TaskList, self).__init__(0, len(TASK_COLUMNS), parent)
+        self.setHorizontalHeaderLabels(TASK_COLUMNS)
+        self.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.verticalHeader().setVisible(False)
+        self.rows = []
+
+    def add(self, task):
+        self.prune()
+        row = self.rowCount()
+        self.insertRow(row)
+        self.setItem(row, 0, QTableWidgetItem(task.name))
+        status = QTableWidgetItem("Queued")
+        self.setItem(row, 1, status)
+        button = QPushButton("Cancel")
+        button.clicked.connect(task.cancel)
+        self.setCellWidget(row, 2, button)
+        self.rows.append(task)
+
+        def done(text):
+            status.setText(text)
+            button.setEnabled(False)
+
+        task.signals.progress.connect(lambda percent: status.setText("{}%".format(percent)))
+        task.signals.finished.connect(lambda _: done("Cancelled" if task.cancelled() else "Done"))
+        task.signals.error.connect(lambda message: done("Cancelled" if task.cancelled() else "Failed"))
+
+    def prune(self):
+        # Drop the oldest finished rows once the list is full.
+        row = 0
+        while len(self.rows) >= TASK_LIST_ROWS and row < len(self.rows):
+            if self.cellWidget(row, 2).isEnabled():
+                row += 1
+                continue
+            self.removeRow(row)
+            del self.rows[row]
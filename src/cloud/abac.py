@@ -1,5 +1,21 @@
 from charm.toolbox.policytree import PolicyParser
 
+VIEW_POLICIES = {
+    'health_record': ['doctor', 'nurse', 'patient'],
+    'medicine_record': ['doctor', 'pharmacist', 'patient'],
+    'financial_record': ['financial'],
+    'research_record': ['doctor', 'researcher'],
+}
+
+UPDATE_POLICIES = {
+    'health_record': ['doctor', 'nurse'],
+    'medicine_record': ['doctor', 'pharmacist'],
+    'financial_record': ['financial'],
+    'research_record': ['doctor', 'researcher'],
+}
+
+DECISION_MEMO_SIZE = 4096
+
 class ABAC:
     attr_dict = {
         'neurology_doctor': '1',
@@ -63,4 +79,39 @@ def checker(user_attr, POLICY):
 
     if not abac.check(attr, pol):
         return False
-    return True
\ No newline at end of file
+    return True
+
+class DecisionTable:
+    '''
+    checker() grants access when some policy attribute known to ABAC.attr_dict
+    is a substring of one of the user's attributes. Compiling each collection's
+    policy into a bitmask over that vocabulary turns the decision into a single
+    AND, with the user's mask memoized per attribute set.
+    '''
+
+    def __init__(self, policies, vocabulary=ABAC.attr_dict):
+        self.policies = policies
+        self.bits = {attr: 1 << i for i, attr in enumerate(vocabulary)}
+        self.masks = {}
+        for collection, policy in policies.items():
+            mask = 0
+            for p in policy:
+                mask |= self.bits.get(p, 0)
+            self.masks[collection] = mask
+        self.memo = {}
+
+    def userMask(self, user_attr):
+        key = frozenset(user_attr)
+        mask = self.memo.get(key)
+        if mask is None:
+            mask = 0
+            for attr, bit in self.bits.items():
+                if any(attr in a for a in key):
+                    mask |= bit
+            if len(self.memo) < DECISION_MEMO_SIZE:
+                self.memo[key] = mask
+
+        return mask
+
+    def allows(self, user_attr, collection):
+        return self.userMask(user_attr) & self.masks[collection] != 0
@@ -1,4 +1,5 @@
-from flask import Flask
+from flask import Flask, jsonify
+from database import mongo
 from user_api import user_api
 from patient_api import patient_api
 import os
@@ -11,6 +12,17 @@ app.config['SESSION_TYPE'] = 'filesystem'
 app.register_blueprint(user_api)
 app.register_blueprint(patient_api)
 
+# Indexes and seed data are set up in the background; requests are served
+# as soon as Mongo answers.
+mongo.start()
+
+
+@app.route('/api/health', methods=['GET'])
+def health():
+    status = mongo.health()
+
+    return jsonify(status), 200 if status['reachable'] else 503
+
 
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=8000, debug=False)
\ No newline at end of file
@@ -1,8 +1,53 @@
 from functools import wraps
 from traceback import print_exc
+from collections import OrderedDict
+from hashlib import sha256
+from ast import literal_eval
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+import threading
+import time
 import jwt
 from flask import request
 
+PUBLIC_KEY_PATH = './keys/jwtkey_pub.pem'
+TOKEN_CACHE_SIZE = 4096
+
+with open(PUBLIC_KEY_PATH, 'rb') as file:
+    public_key = load_pem_public_key(file.read())
+
+class TokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, digest):
+        with self.lock:
+            user = self.entries.get(digest)
+            if user is None:
+                return None
+            if user['expiry'] < time.time():
+                del self.entries[digest]
+                return None
+
+            self.entries.move_to_end(digest)
+            return user
+
+    def put(self, digest, user):
+        with self.lock:
+            self.entries[digest] = user
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+token_cache = TokenCache()
+
+def parseUser(claims):
+    return {
+        'user_id': claims['user_id'],
+        'attribute': tuple(literal_eval(claims['attribute'])),
+        'expiry': float(claims['expiry'])
+    }
+
 def check_token(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -14,14 +59,21 @@ def check_token(f):
         if not token:
             return {"message": "Authentication Token is missing!", "data": None, "error": "Unauthorized"}, 401
 
-        try:
-            with open('./keys/jwtkey_pub.pem', 'rb') as file:
-                key = file.read()
-                user = jwt.decode(token, key, algorithms="EdDSA")
-        except Exception:
-            print_exc()
-            return {"message": "Something went wrong", "data": None}, 500
+        # Signature checks are paid once per token; later requests with the
+        # same token reuse the parsed principal until it expires.
+        digest = sha256(token.encode()).digest()
+        user = token_cache.get(digest)
+        if user is None:
+            try:
+                user = parseUser(jwt.decode(token, public_key, algorithms="EdDSA"))
+            except Exception:
+                print_exc()
+                return {"message": "Something went wrong", "data": None}, 500
+
+            if user['expiry'] < time.time():
+                return {"message": "Authentication Token has expired!", "data": None, "error": "Unauthorized"}, 401
+            token_cache.put(digest, user)
 
         return f(user, *args, **kwargs)
 
-    return decorated
\ No newline at end of file
+    return decorated
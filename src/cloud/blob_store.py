@@ -0,0 +1,53 @@
+from gridfs import GridFSBucket
+from hashlib import sha256
+
+BLOB_BUCKET = 'attachments'
+BLOB_CHUNK_SIZE = 255 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+
+class BlobStore:
+    def __init__(self, db, bucket_name=BLOB_BUCKET):
+        self.bucket = GridFSBucket(db, bucket_name=bucket_name, chunk_size_bytes=BLOB_CHUNK_SIZE)
+
+    def put(self, stream, file_name, metadata=None):
+        # Copy from any file-like object chunk by chunk, hashing on the way, so
+        # the attachment is never held in memory as a whole.
+        digest = sha256()
+        size = 0
+        grid_in = self.bucket.open_upload_stream(file_name, metadata=metadata)
+        try:
+            while True:
+                chunk = stream.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+                grid_in.write(chunk)
+        except BaseException:
+            grid_in.abort()
+            raise
+        grid_in.close()
+
+        return {
+            'file_id': grid_in._id,
+            'file_size': size,
+            'file_hash': digest.hexdigest()
+        }
+
+    def open(self, file_id):
+        return self.bucket.open_download_stream(file_id)
+
+    def stream(self, file_id, start=0, stop=None):
+        with self.open(file_id) as grid_out:
+            # GridFS seeks straight to the chunk holding 'start'.
+            grid_out.seek(start)
+            remaining = (grid_out.length if stop is None else stop) - start
+            while remaining > 0:
+                chunk = grid_out.read(min(STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def delete(self, file_id):
+        self.bucket.delete(file_id)
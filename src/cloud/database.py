@@ -0,0 +1,221 @@
+from pymongo import MongoClient, WriteConcern, ASCENDING
+from pymongo.monitoring import ConnectionPoolListener
+from pymongo.read_preferences import read_pref_mode_from_name, make_read_preference
+from pymongo.errors import AutoReconnect, PyMongoError
+from functools import wraps
+from traceback import print_exc
+import threading
+import pymongo
+import time
+
+MONGO_URI = "mongodb://localhost:27017/"
+MAX_POOL_SIZE = 100
+MIN_POOL_SIZE = 0
+CONNECT_TIMEOUT_MS = 5000
+SERVER_SELECTION_TIMEOUT_MS = 5000
+SOCKET_TIMEOUT_MS = 30000
+WAIT_QUEUE_TIMEOUT_MS = 5000
+READ_PREFERENCE = 'primary'
+WRITE_CONCERN = {'w': 1}
+HEALTH_TIMEOUT = 1.0
+PROVISION_RETRY = 2.0
+PROVISION_MAX_RETRY = 60.0
+
+class PoolMonitor(ConnectionPoolListener):
+    # Connection counts across every server the client talks to; read by
+    # the health endpoint.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.checkout_failures = 0
+
+    def _add(self, **deltas):
+        with self.lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._add(open=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add(open=-1)
+
+    def connection_check_out_started(self, event):
+        self._add(waiting=1)
+
+    def connection_check_out_failed(self, event):
+        self._add(waiting=-1, checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        self._add(waiting=-1, in_use=1)
+
+    def connection_checked_in(self, event):
+        self._add(in_use=-1)
+
+    def stats(self, max_size):
+        with self.lock:
+            return {
+                'max_size': max_size,
+                'open': self.open,
+                'in_use': self.in_use,
+                'waiting': self.waiting,
+                'checkout_failures': self.checkout_failures,
+                'saturation': round(self.in_use / max_size, 3) if max_size else None
+            }
+
+class Database:
+    def __init__(self, uri=MONGO_URI, max_pool_size=MAX_POOL_SIZE, min_pool_size=MIN_POOL_SIZE,
+                 connect_timeout_ms=CONNECT_TIMEOUT_MS, server_selection_timeout_ms=SERVER_SELECTION_TIMEOUT_MS,
+                 socket_timeout_ms=SOCKET_TIMEOUT_MS, wait_queue_timeout_ms=WAIT_QUEUE_TIMEOUT_MS,
+                 read_preference=READ_PREFERENCE, write_concern=WRITE_CONCERN):
+        self.uri = uri
+        self.max_pool_size = max_pool_size
+        self.options = {
+            'maxPoolSize': max_pool_size,
+            'minPoolSize': min_pool_size,
+            'connectTimeoutMS': connect_timeout_ms,
+            'serverSelectionTimeoutMS': server_selection_timeout_ms,
+            'socketTimeoutMS': socket_timeout_ms,
+            'waitQueueTimeoutMS': wait_queue_timeout_ms
+        }
+        self.read_preference = make_read_preference(read_pref_mode_from_name(read_preference), None)
+        self.write_concern = WriteConcern(**write_concern)
+        self.monitor = PoolMonitor()
+        self.lock = threading.Lock()
+        self._client = None
+
+        self.provisioners = []
+        self.provisioned = {}
+        self.provision_errors = {}
+        self.thread = None
+
+    @property
+    def client(self):
+        # Created on first use with connect=False: nothing blocks until an
+        # operation actually needs a server.
+        if self._client is None:
+            with self.lock:
+                if self._client is None:
+                    self._client = MongoClient(self.uri, connect=False, event_listeners=[self.monitor], **self.options)
+
+        return self._client
+
+    def get(self, name):
+        return self.client.get_database(name, read_preference=self.read_preference, write_concern=self.write_concern)
+
+    def provision(self, name, fn=None):
+        # Index creation and seeding to run once, off the request path. Routes
+        # wait on the name of the provisioner they depend on, so one that
+        # fails does not hold up unrelated writes.
+        if fn is None:
+            return lambda fn: self.provision(name, fn)
+
+        self.provisioners.append((name, fn))
+        self.provisioned[name] = threading.Event()
+
+        return fn
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._provision, daemon=True)
+                self.thread.start()
+
+    def _provision(self):
+        delay = PROVISION_RETRY
+        pending = list(self.provisioners)
+        while pending:
+            name, fn = pending[0]
+            try:
+                fn()
+            except AutoReconnect as e:
+                # Server not reachable yet: keep trying with backoff.
+                self.provision_errors[name] = str(e)
+                time.sleep(delay)
+                delay = min(delay * 2, PROVISION_MAX_RETRY)
+                continue
+            except Exception as e:
+                # Not retried: the data needs fixing (e.g. duplicate uids).
+                # Routes depending on this one stay refused.
+                print_exc()
+                self.provision_errors[name] = str(e)
+            else:
+                self.provision_errors.pop(name, None)
+                self.provisioned[name].set()
+            pending.pop(0)
+            delay = PROVISION_RETRY
+
+    def health(self):
+        result = {
+            'pool': self.monitor.stats(self.max_pool_size),
+            'provisioned': {name: event.is_set() for name, event in self.provisioned.items()},
+            'provision_errors': dict(self.provision_errors)
+        }
+        start = time.perf_counter()
+        try:
+            with pymongo.timeout(HEALTH_TIMEOUT):
+                self.client.admin.command('ping')
+            result['reachable'] = True
+            result['latency_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        except PyMongoError as e:
+            result['reachable'] = False
+            result['error'] = str(e)
+
+        return result
+
+mongo = Database()
+
+def ensureUnique(collection, field):
+    # Writes rely on this index to reject duplicates atomically. Older
+    # deployments have a plain index or none at all; either way the data is
+    # checked first so duplicates are reported by value rather than as a bare
+    # index build failure.
+    name = field + '_1'
+    index = collection.index_information().get(name)
+    if index is not None and index.get('unique', False):
+        return
+
+    duplicates = list(collection.aggregate([
+        {'$group': {'_id': '$' + field, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+        {'$limit': 5}
+    ]))
+    if duplicates:
+        raise RuntimeError('{} has duplicate {}s, e.g. {}; resolve them before starting'.format(
+            collection.name, field, ', '.join(repr(doc['_id']) for doc in duplicates)))
+
+    if index is not None:
+        collection.drop_index(name)
+    collection.create_index([(field, ASCENDING)], unique=True)
+
+def check_provisioned(name):
+    # For routes whose correctness depends on the unique indexes: refused
+    # until the named provisioner has completed.
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if not mongo.provisioned[name].is_set():
+                return {"error": "Service is starting up or needs attention, retry later"}, 503
+
+            return f(*args, **kwargs)
+
+        return decorated
+
+    return decorator
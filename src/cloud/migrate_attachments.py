@@ -0,0 +1,26 @@
+from patient_api import db, blobs, UPDATE_POLICIES
+import io
+
+# One-off move of attachments stored inline as 'file_data' strings into the
+# GridFS bucket; records keep only the file_id, size and hash.
+for name in UPDATE_POLICIES:
+    collection = db[name]
+    moved = 0
+    for doc in collection.find({'file_data': {'$exists': True}}, {'_id': 1, 'uid': 1, 'file_name': 1, 'file_data': 1}):
+        file_data = doc['file_data']
+        fields = blobs.put(
+            io.BytesIO(file_data.encode() if isinstance(file_data, str) else file_data),
+            doc.get('file_name', ''),
+            metadata={'collection_name': name, 'uid': doc.get('uid')}
+        )
+        result = collection.update_one(
+            {'_id': doc['_id'], 'file_data': file_data},
+            {'$set': fields, '$unset': {'file_data': ''}}
+        )
+        if result.modified_count == 0:
+            # The record changed underneath us; leave it for the next run.
+            blobs.delete(fields['file_id'])
+        else:
+            moved += 1
+
+    print('{}: moved {} attachments'.format(name, moved))
@@ -1,37 +1,154 @@
-from flask import Blueprint, request, jsonify
-from abac import checker
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+from abac import VIEW_POLICIES, UPDATE_POLICIES, DecisionTable
 from authorize import check_token
-from pymongo import MongoClient
-from pymongo.errors import ServerSelectionTimeoutError
-from ast import literal_eval
+from search_index import MATCH_MODES, SORT_ORDERS, ensureIndexes, nameFields, nameQuery, encodeCursor, cursorQuery
+from blob_store import BlobStore
+from database import mongo, check_provisioned
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import json
+import io
 
 patient_api = Blueprint('patient_api', __name__)
 
-def DBConnect():
-    client = MongoClient("mongodb://localhost:27017/")
+db = mongo.get("hospital")
+blobs = BlobStore(db)
+
+VIEW_TABLE = DecisionTable(VIEW_POLICIES)
+UPDATE_TABLE = DecisionTable(UPDATE_POLICIES)
+
+SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_PAGE_SIZE = 500
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+BATCH_MAX_RECORDS = 500
+BATCH_MAX_BYTES = 256 * 1024 * 1024
+DUPLICATE_KEY = 11000
+METADATA_HEADER = 'X-Record-Metadata'
+
+METADATA_PROJECTION = {"_id": 0, "uid": 1, "patient_name": 1, "file_name": 1, "file_size": 1, "file_hash": 1}
+
+mongo.provision('records', lambda: ensureIndexes(db, UPDATE_POLICIES))
+
+def storeAttachment(collection_name, uid, file_name, stream):
+    return blobs.put(stream, file_name, metadata={'collection_name': collection_name, 'uid': uid})
+
+def createRecord(collection_name, patient_data, stream):
+    collection = db[collection_name]
+    patient_id = patient_data.get('uid')
+
+    patient_data.update(nameFields(str(patient_data.get('patient_name', ''))))
+    patient_data.update(storeAttachment(collection_name, patient_id, patient_data.get('file_name', ''), stream))
+    # The unique uid index decides: no separate existence check to race with.
     try:
-        client.server_info()
-    except ServerSelectionTimeoutError:
-        client = MongoClient("mongodb://localhost:27017/")
-    db = client["hospital"]
-    
-    return db
+        collection.insert_one(patient_data)
+    except DuplicateKeyError:
+        blobs.delete(patient_data['file_id'])
+        return jsonify({"error": "Record with the provided UID already exists"}), 409
+
+    return jsonify({"message": "Record uploaded successfully", "inserted_id": patient_id}), 200
+
+def modifyRecord(collection_name, updated_data, stream):
+    collection = db[collection_name]
+    uid = updated_data.get('uid')
+
+    update = {"$set": updated_data}
+    if 'patient_name' in updated_data:
+        updated_data.update(nameFields(str(updated_data['patient_name'])))
+    if stream is None:
+        if collection.update_one({"uid": uid}, update).matched_count == 0:
+            return jsonify({"error": "Patient record not found"}), 404
+        return jsonify({"message": "Record updated successfully"}), 200
+
+    updated_data.update(storeAttachment(collection_name, uid, updated_data.get('file_name', ''), stream))
+    update["$unset"] = {"file_data": ""}
+    # One round-trip: the document as it was before tells us which
+    # attachment to drop, or that there was no such record.
+    existing_record = collection.find_one_and_update({"uid": uid}, update, projection={"file_id": 1}, return_document=ReturnDocument.BEFORE)
+    if existing_record is None:
+        blobs.delete(updated_data['file_id'])
+        return jsonify({"error": "Patient record not found"}), 404
+
+    # The previous attachment is only dropped once the record points elsewhere.
+    if existing_record.get('file_id') is not None:
+        blobs.delete(existing_record['file_id'])
+
+    return jsonify({"message": "Record updated successfully"}), 200
+
+def createRecords(collection_name, records, files):
+    # One result per record, in request order: inserted, duplicate or rejected.
+    collection = db[collection_name]
+    results = [{"uid": record.get('uid') if isinstance(record, dict) else None} for record in records]
+
+    seen = set()
+    pending = []
+    for index, record in enumerate(records):
+        if not isinstance(record, dict) or not isinstance(record.get('uid'), str) or record['uid'] == '':
+            results[index].update(status="rejected", error="A non-empty uid is required")
+        elif files.get(str(record.get('file', ''))) is None:
+            results[index].update(status="rejected", error="Missing attachment part")
+        elif record['uid'] in seen:
+            results[index].update(status="duplicate")
+        else:
+            seen.add(record['uid'])
+            pending.append(index)
 
-db = DBConnect()
+    # One round-trip for every uid already on the server.
+    existing = collection.find({"uid": {"$in": [records[i]['uid'] for i in pending]}}, {"_id": 0, "uid": 1})
+    existing = set(doc['uid'] for doc in existing)
 
-VIEW_POLICIES = {
-    'health_record': ['doctor', 'nurse', 'patient'],
-    'medicine_record': ['doctor', 'pharmacist', 'patient'],
-    'financial_record': ['financial'],
-    'research_record': ['doctor', 'researcher'],
-}
+    documents, indexes = [], []
+    for index in pending:
+        record = records[index]
+        if record['uid'] in existing:
+            results[index].update(status="duplicate")
+            continue
 
-UPDATE_POLICIES = {
-    'health_record': ['doctor', 'nurse'],
-    'medicine_record': ['doctor', 'pharmacist'],
-    'financial_record': ['financial'],
-    'research_record': ['doctor', 'researcher'],
-}
+        patient_data = {
+            'uid': record['uid'],
+            'patient_name': str(record.get('patient_name', '')),
+            'file_name': str(record.get('file_name', ''))
+        }
+        patient_data.update(nameFields(patient_data['patient_name']))
+        patient_data.update(storeAttachment(collection_name, record['uid'], patient_data['file_name'], files[str(record['file'])].stream))
+        documents.append(patient_data)
+        indexes.append(index)
+
+    failed = {}
+    if documents:
+        try:
+            collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            # Unordered: every document without an error was still written.
+            failed = {error['index']: error for error in e.details.get('writeErrors', [])}
+
+    for position, index in enumerate(indexes):
+        error = failed.get(position)
+        if error is None:
+            results[index].update(status="inserted")
+            continue
+
+        blobs.delete(documents[position]['file_id'])
+        if error.get('code') == DUPLICATE_KEY:
+            results[index].update(status="duplicate")
+        else:
+            results[index].update(status="rejected", error=error.get('errmsg', 'Write failed'))
+
+    summary = {status: sum(1 for result in results if result['status'] == status) for status in ("inserted", "duplicate", "rejected")}
+    return jsonify(dict(summary, results=results)), 200
+
+def streamParams():
+    # Record fields travel as one JSON header next to the streamed body:
+    # unlike the query string, it is not written to access logs. Raises
+    # ValueError when the header is not a JSON object.
+    metadata = json.loads(request.headers.get(METADATA_HEADER, '{}'))
+    if not isinstance(metadata, dict):
+        raise ValueError('Record metadata must be a JSON object')
+
+    return {
+        'uid': str(metadata.get('uid', '')),
+        'patient_name': str(metadata.get('patient_name', '')),
+        'file_name': str(metadata.get('file_name', ''))
+    }
 
 @patient_api.route("/api/search_record", methods=["POST"])
 @check_token
@@ -41,11 +158,26 @@ def searchRecord(user):
     uid = data.get("uid", "")
     collection_name = data.get("collection_name", "")
     patient_name = data.get("patient_name", "")
+    match = data.get("match", "substring")
+    ignore_case = bool(data.get("ignore_case", False))
+    limit = data.get("limit", SEARCH_PAGE_SIZE)
+    order = data.get("order", "asc")
+    cursor = data.get("cursor")
+    with_count = bool(data.get("with_count", False))
 
-    user_attr = literal_eval(user['attribute'])
+    if match not in MATCH_MODES:
+        return jsonify({"error": "Invalid match mode"}), 400
+    if order not in SORT_ORDERS:
+        return jsonify({"error": "Invalid sort order"}), 400
+    if cursor is not None and not isinstance(cursor, str):
+        return jsonify({"error": "Invalid cursor"}), 400
+    # bool is an int subclass: 'true' must not pass as a page size of 1.
+    if isinstance(limit, bool) or not isinstance(limit, int) or not 0 < limit <= SEARCH_MAX_PAGE_SIZE:
+        return jsonify({"error": "limit must be between 1 and {}".format(SEARCH_MAX_PAGE_SIZE)}), 400
+
+    user_attr = user['attribute']
     if collection_name in UPDATE_POLICIES:
-        POLICY = UPDATE_POLICIES[collection_name]
-        if not checker(user_attr, POLICY):
+        if not UPDATE_TABLE.allows(user_attr, collection_name):
             return jsonify({"error": "You don't have permission to view this"}), 404
     else:
         return jsonify({"error": "Invalid collection name"}), 400
@@ -54,10 +186,27 @@ def searchRecord(user):
     if uid != "":
         query_criteria["uid"] = uid
     if patient_name != "":
-        query_criteria["patient_name"] = {"$regex": f".*{patient_name}.*"}
-    result = db[collection_name].find(query_criteria, {"_id": 0, "patient_name": 1, "uid": 1})
+        query_criteria.update(nameQuery(str(patient_name), match, ignore_case))
+
+    page_criteria = query_criteria
+    if cursor:
+        try:
+            page_criteria = {"$and": [query_criteria, cursorQuery(cursor, order)]}
+        except (ValueError, KeyError, TypeError):
+            return jsonify({"error": "Invalid cursor"}), 400
+
+    collection = db[collection_name]
+    result = collection.find(page_criteria, {"_id": 0, "patient_name": 1, "uid": 1})
+    result = list(result.sort("uid", ASCENDING if order == "asc" else DESCENDING).limit(limit + 1))
+
+    server_response = {
+        "results": result[:limit],
+        "next_cursor": encodeCursor(result[limit - 1]["uid"], order) if len(result) > limit else None
+    }
+    if with_count:
+        server_response["total"] = collection.count_documents(query_criteria)
     
-    return jsonify(list(result)), 200
+    return jsonify(server_response), 200
 
 
 @patient_api.route('/api/view_patient_record', methods=['POST'])
@@ -68,10 +217,9 @@ def viewRecord(user):
     collection_name = data.get('collection_name', '')
     uid = data.get('uid', '')
 
-    user_attr = literal_eval(user['attribute'])
+    user_attr = user['attribute']
     if collection_name in VIEW_POLICIES:
-        POLICY = VIEW_POLICIES[collection_name]
-        if not checker(user_attr, POLICY):
+        if not VIEW_TABLE.allows(user_attr, collection_name):
             return jsonify({"error": "You don't have permission to view this"}), 404
     else:
         return jsonify({"error": "Invalid collection name"}), 400
@@ -80,14 +228,62 @@ def viewRecord(user):
     if uid != "":
         query_criteria["uid"] = uid
     collection = db[collection_name]
-    patient_record = collection.find(query_criteria, {"_id": 0})
+    patient_record = collection.find(query_criteria, METADATA_PROJECTION)
     if not patient_record:
         return jsonify({"error": "Patient record not found"}), 404
 
     return jsonify({"message": "Record retrieved successfully", "patient_data": list(patient_record)}), 200
 
 
+@patient_api.route('/api/download_patient_file', methods=['GET'])
+@check_token
+def downloadFile(user):
+    collection_name = request.args.get('collection_name', '')
+    uid = request.args.get('uid', '')
+
+    user_attr = user['attribute']
+    if collection_name in VIEW_POLICIES:
+        if not VIEW_TABLE.allows(user_attr, collection_name):
+            return jsonify({"error": "You don't have permission to view this"}), 404
+    else:
+        return jsonify({"error": "Invalid collection name"}), 400
+
+    record = db[collection_name].find_one({"uid": uid}, {"_id": 0, "file_id": 1, "file_size": 1, "file_data": 1})
+    if record is None or ('file_id' not in record and 'file_data' not in record):
+        return jsonify({"error": "Patient record not found"}), 404
+
+    size = record['file_size'] if 'file_id' in record else len(record['file_data'])
+    start, stop = 0, size
+    status = 200
+    headers = {'Accept-Ranges': 'bytes'}
+
+    # Single byte ranges are served as 206; multi-range requests get the
+    # whole body, which RFC 9110 allows.
+    if request.range is not None and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            return jsonify({"error": "Requested range not satisfiable"}), 416, {'Content-Range': 'bytes */{}'.format(size)}
+        start, stop = byte_range
+        status = 206
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, size)
+    headers['Content-Length'] = str(stop - start)
+
+    if 'file_id' in record:
+        body = blobs.stream(record['file_id'], start, stop)
+    else:
+        # Not migrated to GridFS yet: slice the inline string instead.
+        file_data = record['file_data']
+
+        def generate():
+            for i in range(start, stop, DOWNLOAD_CHUNK_SIZE):
+                yield file_data[i:min(i + DOWNLOAD_CHUNK_SIZE, stop)].encode()
+        body = generate()
+
+    return Response(stream_with_context(body), status=status, headers=headers, mimetype='application/octet-stream')
+
+
 @patient_api.route('/api/upload_patient_record', methods=['POST'])
+@check_provisioned('records')
 @check_token
 def uploadPatient(user):
     data = request.json
@@ -95,47 +291,115 @@ def uploadPatient(user):
     collection_name = data.get('collection_name')
     patient_data = data.get('patient_data', {})
 
-    user_attr = literal_eval(user['attribute'])
+    user_attr = user['attribute']
     if collection_name in UPDATE_POLICIES:
-        POLICY = UPDATE_POLICIES[collection_name]
-        if not checker(user_attr, POLICY):
+        if not UPDATE_TABLE.allows(user_attr, collection_name):
             return jsonify({"error": "You don't have permission to upload this"}), 404
     else:
         return jsonify({"error": "Invalid collection name"}), 400
 
 
-    collection = db[collection_name]
-    patient_id = patient_data.get('uid')
-    existing_record = collection.find_one({'uid': patient_id})
-    if existing_record is None:
-        result = collection.insert_one(patient_data)
-        return jsonify({"message": "Record uploaded successfully", "inserted_id": patient_id}), 200
+    file_data = str(patient_data.pop('file_data', ''))
+
+    return createRecord(collection_name, patient_data, io.BytesIO(file_data.encode()))
+
+
+@patient_api.route('/api/upload_patient_file', methods=['POST'])
+@check_provisioned('records')
+@check_token
+def uploadPatientFile(user):
+    collection_name = request.args.get('collection_name')
+
+    user_attr = user['attribute']
+    if collection_name in UPDATE_POLICIES:
+        if not UPDATE_TABLE.allows(user_attr, collection_name):
+            return jsonify({"error": "You don't have permission to upload this"}), 404
     else:
-        return jsonify({"error": "Record with the provided UID already exists"}), 409
+        return jsonify({"error": "Invalid collection name"}), 400
+
+    # Record fields come in a header so the body can be streamed straight
+    # into GridFS.
+    try:
+        patient_data = streamParams()
+    except ValueError:
+        return jsonify({"error": "Invalid record metadata"}), 400
+
+    return createRecord(collection_name, patient_data, request.stream)
+
+
+@patient_api.route('/api/upload_patient_records_batch', methods=['POST'])
+@check_provisioned('records')
+@check_token
+def uploadPatientBatch(user):
+    collection_name = request.args.get('collection_name')
+
+    user_attr = user['attribute']
+    if collection_name in UPDATE_POLICIES:
+        if not UPDATE_TABLE.allows(user_attr, collection_name):
+            return jsonify({"error": "You don't have permission to upload this"}), 404
+    else:
+        return jsonify({"error": "Invalid collection name"}), 400
+
+    # Checked before the multipart body is parsed.
+    if request.content_length is None:
+        return jsonify({"error": "Content-Length is required"}), 411
+    if request.content_length > BATCH_MAX_BYTES:
+        return jsonify({"error": "Batch larger than {} bytes".format(BATCH_MAX_BYTES)}), 413
+
+    # multipart/form-data: 'records' is a JSON list of
+    # {uid, patient_name, file_name, file} where 'file' names the part that
+    # holds the encrypted attachment.
+    try:
+        records = json.loads(request.form.get('records', ''))
+    except ValueError:
+        return jsonify({"error": "records must be a JSON list"}), 400
+    if not isinstance(records, list):
+        return jsonify({"error": "records must be a JSON list"}), 400
+    if len(records) > BATCH_MAX_RECORDS:
+        return jsonify({"error": "At most {} records per batch".format(BATCH_MAX_RECORDS)}), 413
+
+    return createRecords(collection_name, records, request.files)
 
 
 @patient_api.route('/api/update_patient_record', methods=['POST'])
+@check_provisioned('records')
 @check_token
 def updateRecord(user):
     data = request.json
 
     collection_name = data.get('collection_name')
     updated_data = data.get('updated_data', {})
-    uid = updated_data.get('uid')
 
-    user_attr = literal_eval(user['attribute'])
+    user_attr = user['attribute']
     if collection_name in UPDATE_POLICIES:
-        POLICY = UPDATE_POLICIES[collection_name]
-        if not checker(user_attr, POLICY):
+        if not UPDATE_TABLE.allows(user_attr, collection_name):
             return jsonify({"error": "You don't have permission to update this"}), 404
     else:
         return jsonify({"error": "Invalid collection name"}), 400
 
-    collection = db[collection_name]
-    existing_record = collection.find_one({"uid": uid})
-    collection = db[collection_name]
-    if not existing_record:
-        return jsonify({"error": "Patient record not found"}), 404
-    collection.update_one({"uid": uid}, {"$set": updated_data})
+    stream = None
+    if 'file_data' in updated_data:
+        stream = io.BytesIO(str(updated_data.pop('file_data')).encode())
+
+    return modifyRecord(collection_name, updated_data, stream)
+
+
+@patient_api.route('/api/update_patient_file', methods=['POST'])
+@check_provisioned('records')
+@check_token
+def updatePatientFile(user):
+    collection_name = request.args.get('collection_name')
+
+    user_attr = user['attribute']
+    if collection_name in UPDATE_POLICIES:
+        if not UPDATE_TABLE.allows(user_attr, collection_name):
+            return jsonify({"error": "You don't have permission to update this"}), 404
+    else:
+        return jsonify({"error": "Invalid collection name"}), 400
+
+    try:
+        updated_data = streamParams()
+    except ValueError:
+        return jsonify({"error": "Invalid record metadata"}), 400
 
-    return jsonify({"message": "Record updated successfully"}), 200
\ No newline at end of file
+    return modifyRecord(collection_name, updated_data, request.stream)
\ No newline at end of file
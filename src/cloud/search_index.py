@@ -0,0 +1,82 @@
+from pymongo import ASCENDING, UpdateOne
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from database import ensureUnique
+import json
+import re
+
+NGRAM_SIZE = 3
+BACKFILL_BATCH = 1000
+MATCH_MODES = ('substring', 'prefix')
+SORT_ORDERS = ('asc', 'desc')
+
+def grams(text):
+    text = text.lower()
+    result = set()
+    for n in range(1, NGRAM_SIZE + 1):
+        for i in range(len(text) - n + 1):
+            result.add(text[i:i + n])
+
+    return sorted(result)
+
+def nameFields(name):
+    # Derived fields stored next to patient_name so every search mode can be
+    # answered from an index instead of scanning the collection.
+    return {
+        'patient_name_lower': name.lower(),
+        'patient_name_grams': grams(name)
+    }
+
+def nameQuery(name, mode='substring', ignore_case=False):
+    lower = name.lower()
+
+    if mode == 'prefix':
+        if ignore_case:
+            return {'patient_name_lower': {'$regex': '^' + re.escape(lower)}}
+        return {'patient_name': {'$regex': '^' + re.escape(name)}}
+
+    # Substring: narrow down with the n-gram index, then confirm the match
+    # (case and contiguity) on the candidates only.
+    if len(lower) <= NGRAM_SIZE:
+        query = {'patient_name_grams': lower}
+        if ignore_case:
+            return query
+    else:
+        trigrams = sorted({lower[i:i + NGRAM_SIZE] for i in range(len(lower) - NGRAM_SIZE + 1)})
+        query = {'patient_name_grams': {'$all': trigrams}}
+
+    if ignore_case:
+        query['patient_name_lower'] = {'$regex': re.escape(lower)}
+    else:
+        query['patient_name'] = {'$regex': re.escape(name)}
+
+    return query
+
+def encodeCursor(uid, order):
+    return urlsafe_b64encode(json.dumps({'uid': uid, 'order': order}).encode()).decode()
+
+def cursorQuery(cursor, order):
+    # Continuation cursors are (uid) ranges, so deep pages cost the same as
+    # the first one instead of growing with a skip offset.
+    state = json.loads(urlsafe_b64decode(cursor.encode()))
+    if state['order'] != order:
+        raise ValueError('Cursor was issued for a different sort order')
+
+    return {'uid': {'$gt' if order == 'asc' else '$lt': state['uid']}}
+
+def ensureIndexes(db, collections):
+    for name in collections:
+        collection = db[name]
+        ensureUnique(collection, 'uid')
+        collection.create_index([('patient_name', ASCENDING)])
+        collection.create_index([('patient_name_lower', ASCENDING)])
+        collection.create_index([('patient_name_grams', ASCENDING)])
+
+        # Records written before the index existed have no derived fields yet.
+        requests = []
+        for doc in collection.find({'patient_name_grams': {'$exists': False}}, {'_id': 1, 'patient_name': 1}):
+            requests.append(UpdateOne({'_id': doc['_id']}, {'$set': nameFields(str(doc.get('patient_name', '')))}))
+            if len(requests) == BACKFILL_BATCH:
+                collection.bulk_write(requests, ordered=False)
+                requests = []
+        if requests:
+            collection.bulk_write(requests, ordered=False)
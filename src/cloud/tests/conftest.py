@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The cloud modules import each other as top-level modules, as when the
+# service is started from src/cloud.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,53 @@
+from itertools import combinations
+import pytest
+
+pytest.importorskip('charm.toolbox.policytree')
+
+from abac import ABAC, VIEW_POLICIES, UPDATE_POLICIES, DecisionTable, checker
+
+POLICY_TABLES = [VIEW_POLICIES, UPDATE_POLICIES]
+POLICY_IDS = ['view', 'update']
+
+# Attribute values as they show up in tokens: department-qualified roles,
+# per-patient ids and roles outside the vocabulary.
+COMPOUND_ATTRIBUTES = ['neurology_doctor', 'patient12', 'psychiatry_doctor', 'head_nurse', 'pharmacist_intern', 'visitor']
+
+def attributeSets(vocabulary):
+    for n in range(len(vocabulary) + 1):
+        yield from combinations(vocabulary, n)
+
+def mismatches(policies, attribute_sets):
+    table = DecisionTable(policies)
+    result = []
+    for user_attr in attribute_sets:
+        for collection, policy in policies.items():
+            if table.allows(user_attr, collection) != checker(list(user_attr), policy):
+                result.append((collection, user_attr))
+
+    return result
+
+@pytest.mark.parametrize('policies', POLICY_TABLES, ids=POLICY_IDS)
+def test_matches_checker_for_every_vocabulary_combination(policies):
+    assert mismatches(policies, attributeSets(list(ABAC.attr_dict))) == []
+
+@pytest.mark.parametrize('policies', POLICY_TABLES, ids=POLICY_IDS)
+def test_matches_checker_for_compound_attributes(policies):
+    assert mismatches(policies, attributeSets(COMPOUND_ATTRIBUTES)) == []
+
+def test_compound_attributes_grant_their_base_role():
+    view = DecisionTable(VIEW_POLICIES)
+    update = DecisionTable(UPDATE_POLICIES)
+
+    assert view.allows(['patient12'], 'health_record')
+    assert not view.allows(['patient12'], 'financial_record')
+    assert not update.allows(['patient12'], 'health_record')
+    assert view.allows(['neurology_doctor'], 'research_record')
+    assert update.allows(['neurology_doctor'], 'medicine_record')
+    assert not view.allows(['visitor'], 'health_record')
+
+def test_memoized_decision_is_stable():
+    table = DecisionTable(VIEW_POLICIES)
+    first = table.allows(('head_nurse', 'patient12'), 'health_record')
+
+    assert table.allows(('patient12', 'head_nurse'), 'health_record') == first
+    assert len(table.memo) == 1
@@ -1,21 +1,30 @@
 from flask import Blueprint, request, jsonify
-from pymongo import MongoClient
-from pymongo.errors import ServerSelectionTimeoutError
+from database import mongo, check_provisioned, ensureUnique
+from pymongo import ReturnDocument, DESCENDING
+from pymongo.errors import DuplicateKeyError
 
 user_api = Blueprint('user_api', __name__)
 
-def DBConnect():
-    client = MongoClient("mongodb://localhost:27017/")
-    try:
-        client.server_info()
-    except ServerSelectionTimeoutError:
-        client = MongoClient("mongodb://localhost:27017/")
-    
-    # client.drop_database("user")  # Drop the database if it exists for fresh start
-    db = client["user"]
-    collection = db['user_data']
-    
-    collection.create_index([('username', 1)], unique=True)
+USER_ID_ATTEMPTS = 5
+
+db = mongo.get("user")
+collection = db['user_data']
+counters = db['counters']
+
+def seedUserIds():
+    # Start the sequence after the highest id handed out so far; $max keeps
+    # it from ever moving backwards, so this is safe to run at any time.
+    last_user = collection.find_one({}, {'user_id': 1}, sort=[('user_id', DESCENDING)])
+    counters.update_one({'_id': 'user_id'}, {'$max': {'seq': last_user['user_id'] if last_user else 0}}, upsert=True)
+
+@mongo.provision('users')
+def provisionUsers():
+    # db.client.drop_database("user")  # Drop the database if it exists for fresh start
+    # Seeded before the indexes: old data may hold duplicate user_ids, which
+    # makes the unique index build fail, and the counter must be right anyway.
+    seedUserIds()
+    ensureUnique(collection, 'username')
+    ensureUnique(collection, 'user_id')
 
     admin_user = collection.find_one({'username': 'admin'})
     if admin_user is None:
@@ -26,10 +35,17 @@ def DBConnect():
             'attribute': '{"ATTR": ["administrator"]}'
         }
         collection.insert_one(admin_user)
+        seedUserIds()
 
-    return collection
+def nextUserId():
+    # Atomic on the server, so concurrent registrations never share an id.
+    # Never upserted: a missing counter would restart at 1 and reuse ids.
+    counter = counters.find_one_and_update({'_id': 'user_id'}, {'$inc': {'seq': 1}}, return_document=ReturnDocument.AFTER)
+    if counter is None:
+        seedUserIds()
+        counter = counters.find_one_and_update({'_id': 'user_id'}, {'$inc': {'seq': 1}}, return_document=ReturnDocument.AFTER)
 
-collection = DBConnect()
+    return counter['seq']
 
 @user_api.route('/api/get_user_info', methods=['POST'])
 def queryUser():
@@ -53,27 +69,34 @@ def queryUser():
     return "Method Not Allowed", 405
 
 @user_api.route('/api/add_user', methods=['POST'])
+@check_provisioned('users')
 def addUser():
     if request.method == 'POST':
         username = request.form.get('username')
         hash_password = request.form.get('password')
         attribute = request.form.get('attribute')
 
-        user_exists = collection.find_one({'username': username})
-
-        if user_exists:
-            return jsonify({'error': 'User already exists'}), 400
-        else:
+        for _ in range(USER_ID_ATTEMPTS):
             user_data = {
-                'user_id': collection.count_documents({}) + 1,
+                'user_id': nextUserId(),
                 'username': username,
                 'hash_password': hash_password,
                 'attribute': attribute
             }
 
-            collection.insert_one(user_data)
+            # The unique username index rejects existing users.
+            try:
+                collection.insert_one(user_data)
+            except DuplicateKeyError as e:
+                # An id clash only happens while the counter is still being
+                # seeded at startup; take the next one.
+                if 'user_id' in (e.details or {}).get('keyPattern', {}):
+                    continue
+                return jsonify({'error': 'User already exists'}), 400
 
             return jsonify({'status': 'success'}), 201
+
+        return jsonify({'error': 'Could not allocate a user id'}), 503
     
     return "Method Not Allowed", 405
 
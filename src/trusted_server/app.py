@@ -1,6 +1,7 @@
 from flask import Flask
 from login_api import login_api
 from auth_api import auth_api
+from processing import keyring
 import os
 
 app = Flask(__name__)
@@ -11,5 +12,7 @@ app.config['SESSION_TYPE'] = 'filesystem'
 app.register_blueprint(login_api)
 app.register_blueprint(auth_api)
 
+keyring.get()
+
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=5000, debug=True)
\ No newline at end of file
@@ -1,18 +1,90 @@
 from processing import ABE, SelfJWT
+from keygen import KeyCache, QueueFull, KEYGEN_TIMEOUT, key_cache, keygen_pool, keygen_jobs, offline_pool, genDecryptKeys, submitDecryptKey
+from login_api import authenticate
 from flask import Blueprint, jsonify, request, session
+from concurrent.futures import TimeoutError
 from ast import literal_eval
 
 auth_api = Blueprint('auth_api', __name__)
 
+MAX_BATCH_SIZE = 1000
+MAX_POLL_WAIT = 30
+BUSY_ERROR = 'Key generation queue is full, retry later'
+TIMEOUT_ERROR = 'Key generation timed out, retry later'
+
+def parseAttributeSet(entry):
+    # A list of attribute names, or its repr as the older clients send it.
+    # Returns None for anything else.
+    if isinstance(entry, str):
+        try:
+            entry = literal_eval(entry)
+        except (ValueError, TypeError, SyntaxError):
+            return None
+    if not isinstance(entry, (list, tuple)) or not all(isinstance(attr, str) for attr in entry):
+        return None
+
+    return KeyCache.canonical(entry)
+
+def keyAttributes(user_id, attribute):
+    # The attribute set keys are issued for: 'patient' becomes PATIENT<id>,
+    # then upper-cased without underscores to match the policies.
+    return KeyCache.canonical(['PATIENT' + str(user_id) if attr == 'patient' else attr.replace('_', '') for attr in attribute])
+
+@auth_api.route('/bootstrap', methods=['POST'])
+def bootstrap():
+    # Login, token and keys in one round-trip. Credentials are optional when
+    # the session is already logged in.
+    credentials = request.get_json(silent=True) or request.form
+    if credentials.get('username') and credentials.get('password'):
+        error = authenticate(credentials['username'], credentials['password'])
+        if error is not None:
+            return error, 400
+
+    if session.get("ID", "") != "" and session.get("username", "") != "":
+        attribute = keyAttributes(session['ID'], session['attribute'])
+        # Key generation runs in the pool while the token is signed.
+        try:
+            dk = submitDecryptKey(attribute)
+        except QueueFull:
+            return jsonify({'error': BUSY_ERROR}), 503
+        
+        selfjwt = SelfJWT()
+        token = selfjwt.encode(str(session['attribute']), session['ID'])
+        
+        try:
+            dk_key = dk.result(timeout=KEYGEN_TIMEOUT)
+        except TimeoutError:
+            return jsonify({'error': TIMEOUT_ERROR}), 503
+
+        abe = ABE()
+        server_response = {
+            'ID': session['ID'],
+            'attribute': session['attribute'],
+            'key_attribute': list(attribute),
+            'token': token,
+            'pk_key': abe.getMasterPublicKey().decode(),
+            'dk_key': dk_key
+        }
+        
+        return jsonify(server_response), 200
+    else:
+        return "Please login first!", 404
+
 @auth_api.route('/get_keys', methods=['POST'])
 def getKeys():
     if session.get("ID", "") != "" and session.get("username", "") != "":
-        post_data = request.json
-        attribute = post_data['attribute']
+        # Keys are only ever issued for the session's own attributes; any
+        # attribute list in the body is ignored.
+        attribute = keyAttributes(session['ID'], session['attribute'])
         
         abe = ABE()
         pk = abe.getMasterPublicKey().decode()
-        dk = abe.genDecryptKey(literal_eval(attribute)).decode()
+        try:
+            dk = submitDecryptKey(attribute).result(timeout=KEYGEN_TIMEOUT)
+        except QueueFull:
+            return jsonify({'error': BUSY_ERROR}), 503
+        except TimeoutError:
+            return jsonify({'error': TIMEOUT_ERROR}), 503
         
         server_response = {
             'pk_key': pk,
@@ -23,6 +95,79 @@ def getKeys():
     else:
         return "Please login first!", 404
 
+@auth_api.route('/get_keys_batch', methods=['POST'])
+def getKeysBatch():
+    if session.get("ID", "") != "" and 'administrator' in session.get("attribute", []):
+        post_data = request.json
+        attributes = post_data.get('attributes', [])
+        if not isinstance(attributes, list) or len(attributes) > MAX_BATCH_SIZE:
+            return jsonify({'error': 'Expected at most {} attribute sets'.format(MAX_BATCH_SIZE)}), 400
+
+        parsed = [parseAttributeSet(a) for a in attributes]
+        for i, attribute in enumerate(parsed):
+            if attribute is None:
+                return jsonify({'error': 'Attribute set {} is not a list of attribute names'.format(i)}), 400
+        attributes = parsed
+        
+        abe = ABE()
+        pk = abe.getMasterPublicKey().decode()
+        try:
+            dks = genDecryptKeys(attributes)
+        except QueueFull:
+            return jsonify({'error': BUSY_ERROR}), 503
+        except TimeoutError:
+            return jsonify({'error': TIMEOUT_ERROR}), 503
+        
+        server_response = {
+            'pk_key': pk,
+            'keys': [{'attribute': list(a), 'dk_key': dk} for a, dk in zip(attributes, dks)]
+        }
+        
+        return jsonify(server_response), 200
+    else:
+        return "Please login as administrator first!", 404
+
+@auth_api.route('/keygen_jobs', methods=['POST'])
+def submitKeygenJob():
+    if session.get("ID", "") != "" and session.get("username", "") != "":
+        attribute = keyAttributes(session['ID'], session['attribute'])
+
+        try:
+            job_id = keygen_jobs.submit(attribute, session['ID'])
+        except QueueFull:
+            return jsonify({'error': BUSY_ERROR}), 503
+
+        return jsonify({'job_id': job_id}), 202
+    else:
+        return "Please login first!", 404
+
+@auth_api.route('/keygen_jobs/<job_id>', methods=['GET'])
+def pollKeygenJob(job_id):
+    if session.get("ID", "") != "" and session.get("username", "") != "":
+        future = keygen_jobs.get(job_id, session['ID'])
+        if future is None:
+            return jsonify({'error': 'Job not found'}), 404
+
+        wait = min(request.args.get('wait', 0, type=float), MAX_POLL_WAIT)
+        try:
+            dk = future.result(timeout=wait)
+        except TimeoutError:
+            return jsonify({'job_id': job_id, 'status': 'pending'}), 202
+        except Exception:
+            return jsonify({'job_id': job_id, 'status': 'failed'}), 500
+
+        abe = ABE()
+        server_response = {
+            'job_id': job_id,
+            'status': 'done',
+            'pk_key': abe.getMasterPublicKey().decode(),
+            'dk_key': dk
+        }
+
+        return jsonify(server_response), 200
+    else:
+        return "Please login first!", 404
+
 @auth_api.route('/token', methods=['POST'])
 def getToken():
     if session.get("ID", "") != "" and session.get("username", "") != "":
@@ -34,5 +179,19 @@ def getToken():
         token = selfjwt.encode(attribute, user_id)
         
         return token, 200
+    else:
+        return "Please login first!", 404
+
+@auth_api.route('/key_stats', methods=['GET'])
+def keyStats():
+    if session.get("ID", "") != "" and session.get("username", "") != "":
+        server_response = {
+            'key_cache': key_cache.stats(),
+            'keygen_pool': keygen_pool.stats(),
+            'keygen_jobs': keygen_jobs.stats(),
+            'offline_pool': offline_pool.stats()
+        }
+
+        return jsonify(server_response), 200
     else:
         return "Please login first!", 404
\ No newline at end of file
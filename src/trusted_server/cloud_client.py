@@ -0,0 +1,48 @@
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urljoin
+import requests
+
+CLOUD_DOMAIN = "http://localhost:8000"
+POOL_SIZE = 32
+TIMEOUT = (3.05, 10)
+RETRY_TOTAL = 2
+RETRY_BACKOFF = 0.2
+RETRY_STATUSES = (502, 503, 504)
+
+class CloudClient:
+    def __init__(self, domain=CLOUD_DOMAIN, pool_size=POOL_SIZE, timeout=TIMEOUT):
+        self.domain = domain
+        self.timeout = timeout
+
+        # Keep-alive connections to the cloud. Only failures where the request
+        # never reached it (connect errors, gateway statuses) are retried, so
+        # add_user is never applied twice. Once retries run out the last
+        # response is returned as is rather than raised as a RetryError.
+        retry = Retry(total=RETRY_TOTAL, read=0, backoff_factor=RETRY_BACKOFF, status_forcelist=RETRY_STATUSES,
+                      allowed_methods=frozenset(['GET', 'POST']), raise_on_status=False)
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry))
+        self.session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry))
+
+    def post(self, path, data):
+        return self.session.post(urljoin(self.domain, path), data=data, timeout=self.timeout)
+
+    def getUserInfo(self, username):
+        # Returns the user record, or None when the cloud does not know it.
+        response = self.post('/api/get_user_info', {'username': username})
+        if response.status_code != 200:
+            return None
+
+        return response.json()
+
+    def addUser(self, username, hash_password, attribute):
+        data = {
+            'username': username,
+            'password': hash_password,
+            'attribute': attribute
+        }
+
+        return self.post('/api/add_user', data)
+
+cloud = CloudClient()
@@ -13,7 +13,7 @@ pairing_group = PairingGroup("SS512")
 abe = ABE()
 pk, mk = abe.setupKey()
 
-aes = SelfAES()
+aes = SelfAES(aes_key)
 with open('./keys/pk_key', 'wb') as f:
     f.write(aes.encrypt(objectToBytes(pk, pairing_group)))
 with open('./keys/mk_key', 'wb') as f:
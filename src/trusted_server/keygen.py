@@ -0,0 +1,443 @@
+from processing import keyring, precomputeTables, PRECOMPUTE_TABLES
+from charm.toolbox.pairinggroup import PairingGroup, ZR, G2
+from charm.schemes.abenc.abenc_bsw07 import CPabe_BSW07
+from charm.core.engine.util import objectToBytes, bytesToObject
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError, wait
+from collections import OrderedDict, deque
+from traceback import print_exc
+from uuid import uuid4
+import os
+import threading
+import time
+
+KEY_CACHE_SIZE = 256
+KEY_CACHE_TTL = 600
+KEYGEN_WORKERS = os.cpu_count() or 1
+KEYGEN_QUEUE_DEPTH = 64
+KEYGEN_TIMEOUT = 60
+KEYGEN_JOB_TTL = 300
+OFFLINE_POOL_LOW = 16
+OFFLINE_POOL_HIGH = 128
+OFFLINE_PIECES_PER_KEY = 4
+OFFLINE_REFILL_CHUNK = 8
+OFFLINE_RETRY = 1.0
+OFFLINE_MAX_RETRY = 60.0
+
+class QueueFull(Exception):
+    pass
+
+class KeyCache:
+    def __init__(self, maxsize=KEY_CACHE_SIZE, ttl=KEY_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def canonical(attribute):
+        # Charm upper-cases policy attributes, so 'doctor' and 'DOCTOR' are the
+        # same attribute; sorting makes the key independent of client order.
+        return tuple(sorted({attr.strip().upper() for attr in attribute}))
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, generation):
+        with self.lock:
+            # Drop keys generated under a master key that was rotated meanwhile.
+            if generation != self.generation:
+                return
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+key_cache = KeyCache()
+keyring.onReload(key_cache.invalidate)
+
+worker = {}
+
+def initWorker(pk_bytes, mk_bytes):
+    # Runs once per pool process: the master key is deserialized here and
+    # reused for every key that process generates.
+    group = PairingGroup('SS512')
+    worker['group'] = group
+    worker['cpabe'] = CPabe_BSW07(group)
+    worker['pk'] = bytesToObject(pk_bytes, group)
+    if PRECOMPUTE_TABLES:
+        precomputeTables(worker['pk'])
+    worker['mk'] = bytesToObject(mk_bytes, group)
+
+def keygenWorker(attribute):
+    dk = worker['cpabe'].keygen(worker['pk'], worker['mk'], list(attribute))
+
+    return objectToBytes(dk, worker['group']).decode()
+
+def offlineWorker(bases, pieces):
+    # The attribute-independent half of CPabe_BSW07.keygen: the per-key
+    # (g2^r, D) pair and per-attribute (r_j, g^r_j) pairs.
+    group, pk, mk = worker['group'], worker['pk'], worker['mk']
+
+    new_bases = []
+    for _ in range(bases):
+        r = group.random(ZR)
+        g_r = pk['g2'] ** r
+        D = (mk['g2_alpha'] * g_r) ** (1 / mk['beta'])
+        new_bases.append(objectToBytes({'g_r': g_r, 'D': D}, group))
+
+    new_pieces = []
+    for _ in range(pieces):
+        r_j = group.random(ZR)
+        new_pieces.append(objectToBytes({'r_j': r_j, 'Djp': pk['g'] ** r_j}, group))
+
+    return new_bases, new_pieces
+
+def onlineKeygenWorker(attribute, base, pieces):
+    group = worker['group']
+    base = bytesToObject(base, group)
+
+    D_j, D_j_pr = {}, {}
+    for j, piece in zip(attribute, pieces):
+        piece = bytesToObject(piece, group)
+        D_j[j] = base['g_r'] * (group.hash(j, G2) ** piece['r_j'])
+        D_j_pr[j] = piece['Djp']
+    dk = {'D': base['D'], 'Dj': D_j, 'Djp': D_j_pr, 'S': list(attribute)}
+
+    return objectToBytes(dk, group).decode()
+
+class KeygenPool:
+    def __init__(self, workers=KEYGEN_WORKERS, depth=KEYGEN_QUEUE_DEPTH):
+        self.workers = workers
+        self.depth = depth
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pending = 0
+        self.rejected = 0
+
+    def _done(self, future):
+        with self.lock:
+            self.pending -= 1
+
+    def _executor(self):
+        keys = keyring.get()
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    self.workers, initializer=initWorker,
+                    initargs=(keys['pk_bytes'], keys['mk_bytes'])
+                )
+
+            return self.executor
+
+    def submit(self, fn, *args, background=False):
+        # Request-path jobs are admitted up to depth at a time, so a burst of
+        # logins gets 503s instead of an unbounded executor backlog.
+        # Background refills skip the check and are not counted.
+        if not background:
+            with self.lock:
+                if self.pending >= self.depth:
+                    self.rejected += 1
+                    raise QueueFull()
+                self.pending += 1
+
+        try:
+            executor = self._executor()
+            try:
+                future = executor.submit(fn, *args)
+            except RuntimeError:
+                # BrokenProcessPool: a worker died (OOM kill, crash in PBC) and
+                # took the pool down with it. Otherwise a key reload shut this
+                # executor down after we got it. Either way retry once on a
+                # fresh one.
+                self.reset(executor)
+                future = self._executor().submit(fn, *args)
+        except Exception:
+            if not background:
+                self._done(None)
+            raise
+
+        if not background:
+            future.add_done_callback(self._done)
+
+        return future
+
+    def reset(self, broken=None):
+        # With broken, only that executor is dropped: concurrent callers that
+        # saw the same failure replace it once.
+        with self.lock:
+            if broken is not None and broken is not self.executor:
+                return
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'pending': self.pending,
+                'depth': self.depth,
+                'rejected': self.rejected
+            }
+
+keygen_pool = KeygenPool()
+keyring.onReload(keygen_pool.reset)
+
+class OfflinePool:
+    def __init__(self, low=OFFLINE_POOL_LOW, high=OFFLINE_POOL_HIGH, pieces_per_key=OFFLINE_PIECES_PER_KEY):
+        self.low = low
+        self.high = high
+        self.pieces_per_key = pieces_per_key
+        self.bases = deque()
+        self.pieces = deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.refilled = 0
+        self.refill_rate = 0.0
+        self.thread = None
+
+    def start(self):
+        # Started by the first take(), i.e. the first keygen request, so a
+        # process that never serves one (the debug reloader's parent, idle
+        # workers) never spins up the keygen pool to fill it.
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _low(self):
+        return len(self.bases) < self.low or len(self.pieces) < self.low * self.pieces_per_key
+
+    def take(self, count):
+        self.start()
+        with self.lock:
+            # Every component is popped exactly once; reusing randomness
+            # across two keys would let their holders collude.
+            if self.bases and len(self.pieces) >= count:
+                base = self.bases.popleft()
+                pieces = [self.pieces.popleft() for _ in range(count)]
+                self.hits += 1
+                result = base, pieces
+            else:
+                self.misses += 1
+                result = None
+            if self._low():
+                self.wakeup.set()
+
+        return result
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.bases.clear()
+            self.pieces.clear()
+        self.wakeup.set()
+
+    def _run(self):
+        # Must not die: start() never replaces this thread, and without it
+        # every request falls back to a full keygen.
+        delay = OFFLINE_RETRY
+        while True:
+            self.wakeup.wait(timeout=1.0)
+            self.wakeup.clear()
+            with self.lock:
+                low = self._low()
+            if not low:
+                continue
+            try:
+                self._refill()
+            except Exception:
+                print_exc()
+                time.sleep(delay)
+                delay = min(delay * 2, OFFLINE_MAX_RETRY)
+            else:
+                delay = OFFLINE_RETRY
+
+    def _refill(self):
+        start = time.monotonic()
+        made = 0
+        while keygen_pool.pending == 0:
+            with self.lock:
+                generation = self.generation
+                bases = max(self.high - len(self.bases), 0)
+                pieces = max(self.high * self.pieces_per_key - len(self.pieces), 0)
+            if bases == 0 and pieces == 0:
+                break
+
+            futures = []
+            for _ in range(keygen_pool.workers):
+                chunk = (min(bases, OFFLINE_REFILL_CHUNK), min(pieces, OFFLINE_REFILL_CHUNK * self.pieces_per_key))
+                if chunk == (0, 0):
+                    break
+                bases, pieces = bases - chunk[0], pieces - chunk[1]
+                futures.append(keygen_pool.submit(offlineWorker, *chunk, background=True))
+
+            progress = 0
+            for future in futures:
+                try:
+                    new_bases, new_pieces = future.result()
+                except Exception:
+                    continue
+                with self.lock:
+                    if generation != self.generation:
+                        continue
+                    self.bases.extend(new_bases)
+                    self.pieces.extend(new_pieces)
+                    self.refilled += len(new_bases) + len(new_pieces)
+                progress += len(new_bases) + len(new_pieces)
+
+            # Give up on this round if the workers are failing or keys rotated.
+            if progress == 0:
+                break
+            made += progress
+
+        if made:
+            self.refill_rate = made / (time.monotonic() - start)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'bases': len(self.bases),
+                'pieces': len(self.pieces),
+                'low': self.low,
+                'high': self.high,
+                'hits': self.hits,
+                'misses': self.misses,
+                'refilled': self.refilled,
+                'refill_rate': self.refill_rate
+            }
+
+offline_pool = OfflinePool()
+keyring.onReload(offline_pool.invalidate)
+
+inflight = {}
+inflight_lock = threading.Lock()
+
+def submitDecryptKey(attribute):
+    dk = key_cache.get(attribute)
+    if dk is not None:
+        future = Future()
+        future.set_result(dk)
+        return future
+
+    with inflight_lock:
+        # Identical attribute sets requested concurrently share one keygen.
+        future = inflight.get(attribute)
+        if future is not None:
+            return future
+
+        generation = key_cache.generation
+        precomputed = offline_pool.take(len(attribute))
+        if precomputed is None:
+            future = keygen_pool.submit(keygenWorker, attribute)
+        else:
+            future = keygen_pool.submit(onlineKeygenWorker, attribute, *precomputed)
+        inflight[attribute] = future
+
+    def done(future):
+        with inflight_lock:
+            inflight.pop(attribute, None)
+        if future.exception() is None:
+            key_cache.put(attribute, future.result(), generation)
+
+    future.add_done_callback(done)
+    return future
+
+def genDecryptKeys(attributes, timeout=KEYGEN_TIMEOUT):
+    # Raises QueueFull when the pool is saturated by other requests and
+    # TimeoutError when the whole batch is not done within timeout. A batch
+    # larger than the queue waits on its own oldest job for a free slot.
+    deadline = time.monotonic() + timeout
+    futures = {}
+    own = deque()
+    for attribute in attributes:
+        if attribute in futures:
+            continue
+        while True:
+            try:
+                futures[attribute] = submitDecryptKey(attribute)
+                break
+            except QueueFull:
+                while own and own[0].done():
+                    own.popleft()
+                if not own:
+                    raise
+                wait([own.popleft()], timeout=max(deadline - time.monotonic(), 0))
+                if time.monotonic() >= deadline:
+                    raise TimeoutError()
+        own.append(futures[attribute])
+
+    return [futures[attribute].result(timeout=max(deadline - time.monotonic(), 0)) for attribute in attributes]
+
+class KeygenJobs:
+    def __init__(self, ttl=KEYGEN_JOB_TTL):
+        self.ttl = ttl
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def _expire(self):
+        now = time.monotonic()
+        for job_id in [k for k, job in self.jobs.items() if job['expires'] < now]:
+            del self.jobs[job_id]
+
+    def submit(self, attribute, owner):
+        # Admission is the keygen pool's: QueueFull propagates from there.
+        future = submitDecryptKey(attribute)
+
+        job_id = uuid4().hex
+        with self.lock:
+            self._expire()
+            self.jobs[job_id] = {
+                'future': future,
+                'owner': owner,
+                'expires': time.monotonic() + self.ttl
+            }
+
+        return job_id
+
+    def get(self, job_id, owner):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None or job['owner'] != owner:
+            return None
+
+        return job['future']
+
+    def stats(self):
+        with self.lock:
+            return {
+                'jobs': len(self.jobs)
+            }
+
+keygen_jobs = KeygenJobs()
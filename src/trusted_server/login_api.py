@@ -1,9 +1,7 @@
 from processing import SelfAES, Hash
+from cloud_client import cloud
 from flask import Blueprint, render_template, request, redirect, url_for, session, jsonify
-from urllib.parse import urljoin
-import requests, json
-
-CLOUD_DOMAIN =  "http://localhost:8000" 
+import json
 
 login_api = Blueprint('login_api', __name__, template_folder='template')
 
@@ -11,37 +9,40 @@ login_api = Blueprint('login_api', __name__, template_folder='template')
 def home():
     return redirect('/login')
 
+def authenticate(username, password):
+    # Checks the credentials against the cloud and fills the session.
+    # Returns an error message, or None once the user is logged in.
+    user_info = cloud.getUserInfo(username)
+    
+    if user_info is None:
+        return 'Invalid username'
+    if user_info['hash_password'] != Hash.hashing(password):
+        return 'Invalid password'
+
+    session['ID'] = user_info['user_id']
+    session['username'] = username
+    if session['username'] != 'admin':
+        attribute = bytes.fromhex(user_info['attribute'])
+        aes = SelfAES()
+        attribute = json.loads(aes.decrypt(attribute).decode())
+    else:
+        attribute = json.loads(user_info['attribute'])
+        
+    session['attribute'] = attribute['ATTR']
+
+    return None
+
 @login_api.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
-        username = request.form['username']
-        password = request.form['password']
-
-        response = requests.post(urljoin(CLOUD_DOMAIN, '/api/get_user_info'), data={'username': username})
+        error = authenticate(request.form['username'], request.form['password'])
+        if error is not None:
+            return error, 400
         
-        if response.status_code == 200:
-            user_info = response.json()
-
-            if user_info['hash_password'] == Hash.hashing(password):
-                session['ID'] = user_info['user_id']
-                session['username'] = username
-                if session['username'] != 'admin':
-                    attribute = bytes.fromhex(user_info['attribute'])
-                    aes = SelfAES()
-                    attribute = json.loads(aes.decrypt(attribute).decode())
-                else:
-                    attribute = json.loads(user_info['attribute'])
-                    
-                session['attribute'] = attribute['ATTR']
-                
-                if session['attribute'] == ['administrator']:
-                    return redirect('/register')
-                else:
-                    return jsonify({'ID':user_info['user_id'], 'attribute': attribute['ATTR']}), 200
-            else:
-                return 'Invalid password', 400
+        if session['attribute'] == ['administrator']:
+            return redirect('/register')
         else:
-            return 'Invalid username', 400
+            return jsonify({'ID': session['ID'], 'attribute': session['attribute']}), 200
 
     return render_template('login.html')
 
@@ -61,15 +62,9 @@ def register():
         attribute = '{{"ATTR": {}}}'.format(json.dumps([attr.strip() for attr in attribute.split(',')]))
         enc_attribute = aes.encrypt(attribute).hex()
 
-        data = {
-            'username': username,
-            'password': Hash.hashing(password),
-            'attribute': enc_attribute
-        }
-        
-        response = requests.post(urljoin(CLOUD_DOMAIN, '/api/add_user'), data=data)
+        response = cloud.addUser(username, Hash.hashing(password), enc_attribute)
 
-        if response.status_code == 200:
+        if response.status_code in (200, 201):
             return "Success", 200
         elif response.status_code == 400 and response.json().get('error') == 'User already exists':
             return render_template('register.html', error='Username already exists')
@@ -1,15 +1,100 @@
 from charm.toolbox.pairinggroup import PairingGroup
 from charm.schemes.abenc.abenc_bsw07 import CPabe_BSW07
 from charm.core.engine.util import objectToBytes, bytesToObject
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
 from Crypto.Cipher import AES
 from hashlib import sha512
 import jwt
+import os
+import threading
 import time
 import subprocess
-    
+
+KEY_DIR = './keys/'
+PRECOMPUTE_TABLES = True
+
+def precomputeTables(pk):
+    # Fixed-base exponentiation tables for the public parameters; every keygen
+    # and encrypt raises these same bases to fresh exponents.
+    for name in ('g', 'g2', 'h', 'e_gg_alpha'):
+        if not pk[name].preproc:
+            pk[name].initPP()
+
+    return pk
+
+class KeyRing:
+    FILES = ('aes.key', 'pk_key', 'mk_key', 'jwtkey_priv.pem.enc')
+
+    def __init__(self, key_dir=KEY_DIR, check_interval=1.0):
+        self.key_dir = key_dir
+        self.check_interval = check_interval
+        self.group = PairingGroup('SS512')
+        self.lock = threading.Lock()
+        self.current = (None, None)
+        self.checked = 0.0
+        self.listeners = []
+
+    def onReload(self, callback):
+        self.listeners.append(callback)
+
+    def _stamp(self):
+        stamp = []
+        for name in self.FILES:
+            try:
+                st = os.stat(os.path.join(self.key_dir, name))
+                stamp.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                stamp.append(None)
+
+        return tuple(stamp)
+
+    def _read(self, name):
+        with open(os.path.join(self.key_dir, name), 'rb') as f:
+            return f.read()
+
+    def _load(self):
+        keys = {'aes': self._read('aes.key')}
+        aes = SelfAES(keys['aes'])
+        keys['pk_bytes'] = aes.decrypt(self._read('pk_key'))
+        keys['pk'] = bytesToObject(keys['pk_bytes'], self.group)
+        if PRECOMPUTE_TABLES:
+            precomputeTables(keys['pk'])
+        keys['mk_bytes'] = aes.decrypt(self._read('mk_key'))
+        keys['mk'] = bytesToObject(keys['mk_bytes'], self.group)
+        keys['jwt'] = load_pem_private_key(aes.decrypt(self._read('jwtkey_priv.pem.enc')), password=None)
+
+        return keys
+
+    def get(self):
+        stamp, keys = self.current
+        now = time.monotonic()
+        if keys is not None and now - self.checked < self.check_interval:
+            return keys
+
+        with self.lock:
+            self.checked = now
+            new_stamp = self._stamp()
+            stamp, keys = self.current
+            if new_stamp != stamp:
+                try:
+                    # Build the whole snapshot first and swap it in with a single
+                    # assignment, so readers never see a half-rotated key set.
+                    self.current = (new_stamp, self._load())
+                except (OSError, ValueError, KeyError):
+                    # Key files are being rewritten; keep serving the old set.
+                    if keys is None:
+                        raise
+                else:
+                    for callback in self.listeners:
+                        callback()
+
+            return self.current[1]
+
+keyring = KeyRing()
+
 class SelfAES:
-    def __init__(self):
-        self.key = open("./keys/aes.key", "rb").read()
+    def __init__(self, key=None):
+        self.key = key if key is not None else keyring.get()['aes']
 
     def encrypt(self, data):
         if type(data) != type(b''):
@@ -27,27 +112,19 @@ class SelfAES:
         
 class ABE:
     def __init__(self):
-        self.group = PairingGroup('SS512')
+        self.group = keyring.group
         self.cpabe = CPabe_BSW07(self.group)
     
     def setupKey(self):
         return self.cpabe.setup()
     
     def getMasterPublicKey(self):
-        aes = SelfAES()
-        with open('./keys/pk_key', 'rb') as f:
-            pk = aes.decrypt(f.read())
-            
-            return pk
+        return keyring.get()['pk_bytes']
     
     def genDecryptKey(self, attribute: list):
-        aes = SelfAES()
-        with open('./keys/pk_key', 'rb') as f:
-            tmp = aes.decrypt(f.read())
-            self.pk = bytesToObject(tmp, self.group)
-        with open('./keys/mk_key', 'rb') as f:
-            tmp = aes.decrypt(f.read())
-            self.mk = bytesToObject(tmp, self.group)
+        keys = keyring.get()
+        self.pk = keys['pk']
+        self.mk = keys['mk']
 
         dk = self.cpabe.keygen(self.pk, self.mk, attribute)
         
@@ -55,10 +132,7 @@ class ABE:
     
 class SelfJWT:
     def __init__(self):
-        with open("./keys/jwtkey_priv.pem.enc", "rb") as f:
-            encrypted_key = f.read()
-            aes = SelfAES()
-            self.key = aes.decrypt(encrypted_key)
+        self.key = keyring.get()['jwt']
     
     def encode(self, attribute, user_id):
         exp_time = str(round(time.time()) + 3600) 